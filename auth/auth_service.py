@@ -1,13 +1,27 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import bcrypt
+import redis
 import time
 import requests
 import os
+import hmac
+import threading
+from werkzeug.middleware.proxy_fix import ProxyFix
+from hashing import HashPool, HashPoolBusy, calibrate_rounds, hash_rounds
+from throttling import sliding_window
+from migrations import ensure_schema, migrate
 
 app = Flask(__name__)
 
+# Behind the gateway, take the client IP from X-Forwarded-For set by that many proxies.
+# Without it every login through the gateway shares the gateway's IP and its throttle.
+# Clients that can reach this service directly could forge the header, so keep it private.
+if int(os.getenv('TRUSTED_PROXIES', '0')):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('TRUSTED_PROXIES')))
+
 # Configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'postgresql://test_user:test_password@db:5432/test_db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -15,6 +29,43 @@ app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key'  # Change this for producti
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 
+redis_client = redis.StrictRedis(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=0)
+# Helpers share their state through Redis when a host is configured, None keeps it in process
+shared_redis = redis_client if os.getenv('REDIS_HOST') else None
+
+# bcrypt runs on its own bounded pool so hashing bursts cannot stall every request thread
+hash_pool = HashPool(
+    workers=int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1)),
+    max_queue=int(os.getenv('BCRYPT_MAX_QUEUE', '64'))
+)
+
+# bcrypt cost factor: fixed by BCRYPT_ROUNDS, or calibrated at startup to take about BCRYPT_TARGET_MS
+if os.getenv('BCRYPT_ROUNDS'):
+    bcrypt_rounds = int(os.getenv('BCRYPT_ROUNDS'))
+else:
+    bcrypt_rounds = calibrate_rounds(
+        target_ms=float(os.getenv('BCRYPT_TARGET_MS', '100')),
+        min_rounds=int(os.getenv('BCRYPT_MIN_ROUNDS', '10')),
+        max_rounds=int(os.getenv('BCRYPT_MAX_ROUNDS', '16'))
+    )
+
+# Login throttling: sliding windows in Redis when REDIS_HOST is set, in process otherwise
+LOGIN_THROTTLE_WINDOW = int(os.getenv('LOGIN_THROTTLE_WINDOW', '60'))
+login_ip_throttle = sliding_window(
+    shared_redis, 'auth:login:ip',
+    int(os.getenv('LOGIN_IP_LIMIT', '30')), LOGIN_THROTTLE_WINDOW)
+login_username_throttle = sliding_window(
+    shared_redis, 'auth:login:username',
+    int(os.getenv('LOGIN_USERNAME_LIMIT', '10')), LOGIN_THROTTLE_WINDOW)
+
+# Bulk registration limits. The endpoint is for operators importing users: it needs the
+# X-Import-Token header to match REGISTER_BATCH_TOKEN and is disabled while that is unset.
+# One import runs at a time, hashing on at most half of the bcrypt workers.
+REGISTER_BATCH_LIMIT = int(os.getenv('REGISTER_BATCH_LIMIT', '10000'))
+REGISTER_INSERT_BATCH_SIZE = 1000
+REGISTER_BATCH_TOKEN = os.getenv('REGISTER_BATCH_TOKEN')
+register_batch_lock = threading.Lock()
+
 # User Model
 class User(db.Model):
     __tablename__ = 'users'
@@ -24,10 +75,17 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)  # This will store the hashed password
     created_at = db.Column(db.DateTime, default=db.func.now())
 
-    
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+
+def create_app():
+    # Startup only checks the schema version, pending migrations run once under an advisory lock
+    with app.app_context():
+        ensure_schema(db.engine, auto_migrate=os.getenv('MIGRATE_ON_START', 'true').lower() == 'true')
+    return app
+
+@app.cli.command('migrate')
+def migrate_command():
+    # Apply pending schema migrations: flask --app auth_service migrate
+    migrate(db.engine)
 
 def register_with_consul(service_name, service_id, service_port):
     url = "http://localhost:8500/v1/agent/auth/register"
@@ -40,10 +98,42 @@ def register_with_consul(service_name, service_id, service_port):
     }
     requests.put(url, json=data)
 
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(error):
+    response = jsonify({"msg": "Too many password checks in progress, try again later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @app.route('/auth/status', methods=['GET'])
 def status():
     return jsonify({"status": "Auth service is up and running!"}), 200
 
+@app.route('/auth/metrics/hashing', methods=['GET'])
+def hashing_metrics():
+    return jsonify(dict(hash_pool.metrics(), rounds=bcrypt_rounds)), 200
+
+# Optional Redis pre-check: a set of usernames known to be taken, so duplicate-heavy
+# registrations never reach the database or spend bcrypt CPU
+USERNAME_PRECHECK = os.getenv('USERNAME_PRECHECK', 'false').lower() == 'true'
+TAKEN_USERNAMES_KEY = 'auth:usernames'
+
+def username_known_taken(username):
+    if not USERNAME_PRECHECK:
+        return False
+    try:
+        return bool(redis_client.sismember(TAKEN_USERNAMES_KEY, username))
+    except redis.RedisError:
+        return False
+
+def remember_taken_usernames(usernames):
+    if not USERNAME_PRECHECK or not usernames:
+        return
+    try:
+        redis_client.sadd(TAKEN_USERNAMES_KEY, *usernames)
+    except redis.RedisError:
+        pass
+
 # Registration endpoint with password hashing
 @app.route('/auth/register', methods=['POST'])
 def register():
@@ -51,32 +141,129 @@ def register():
     username = data.get('username')
     password = data.get('password')
     
-    # Check if user already exists
-    if User.query.filter_by(username=username).first():
+    # Usernames known to be taken are rejected before any hashing or database work
+    if username_known_taken(username):
         return jsonify({"msg": "Username already exists"}), 409
     
     # Hash the password using bcrypt
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed_password = hash_pool.hashpw(password.encode('utf-8'), bcrypt.gensalt(bcrypt_rounds))
     
-    # Create new user with hashed password
-    new_user = User(username=username, password=hashed_password.decode('utf-8'))
-    db.session.add(new_user)
+    # Create new user with hashed password in one round trip, a taken username inserts nothing
+    user_id = db.session.execute(
+        pg_insert(User)
+        .values(username=username, password=hashed_password.decode('utf-8'))
+        .on_conflict_do_nothing(index_elements=['username'])
+        .returning(User.id)
+    ).scalar()
     db.session.commit()
+    remember_taken_usernames([username])
+
+    if user_id is None:
+        return jsonify({"msg": "Username already exists"}), 409
     
     return jsonify({"msg": "User registered successfully"}), 201
 
+# Bulk registration for imports: one duplicate check, parallel hashing and batched inserts
+@app.route('/auth/register/batch', methods=['POST'])
+def register_batch():
+    token = request.headers.get('X-Import-Token', '')
+    if not REGISTER_BATCH_TOKEN or not hmac.compare_digest(token.encode(), REGISTER_BATCH_TOKEN.encode()):
+        return jsonify({"msg": "Not allowed"}), 403
+
+    data = request.get_json(silent=True)
+    users = data.get('users') if isinstance(data, dict) else None
+    if not isinstance(users, list):
+        return jsonify({"msg": "users must be a list"}), 400
+    if len(users) > REGISTER_BATCH_LIMIT:
+        return jsonify({"msg": f"At most {REGISTER_BATCH_LIMIT} users per batch"}), 400
+
+    if not register_batch_lock.acquire(blocking=False):
+        return jsonify({"msg": "Another import is running, try again later"}), 409
+    try:
+        return register_users(users)
+    finally:
+        register_batch_lock.release()
+
+def register_users(users):
+    results = [None] * len(users)
+    candidates = {}
+    for index, item in enumerate(users):
+        username = item.get('username') if isinstance(item, dict) else None
+        password = item.get('password') if isinstance(item, dict) else None
+        if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
+            results[index] = {"username": username if isinstance(username, str) else None,
+                              "status": "invalid", "msg": "username and password must be non-empty strings"}
+        elif username in candidates:
+            results[index] = {"username": username, "status": "duplicate", "msg": "Username repeated in this batch"}
+        else:
+            candidates[username] = index
+
+    # Check every username in one query
+    existing = set(db.session.scalars(db.select(User.username).where(User.username.in_(list(candidates)))))
+    for username in existing:
+        results[candidates.pop(username)] = {"username": username, "status": "exists", "msg": "Username already exists"}
+
+    # Hash in parallel on the bcrypt pool
+    usernames = list(candidates)
+    hashed_passwords = hash_pool.hashpw_many(
+        [users[candidates[username]]['password'].encode('utf-8') for username in usernames], bcrypt_rounds,
+        concurrency=max(1, hash_pool.workers // 2))
+
+    # Insert in batches, each one multi-row INSERT ... RETURNING
+    rows = [{"username": username, "password": hashed_password.decode('utf-8')}
+            for username, hashed_password in zip(usernames, hashed_passwords)]
+    created_count = 0
+    for start in range(0, len(rows), REGISTER_INSERT_BATCH_SIZE):
+        created = db.session.execute(
+            pg_insert(User).on_conflict_do_nothing(index_elements=['username']).returning(User.id, User.username),
+            rows[start:start + REGISTER_INSERT_BATCH_SIZE]
+        )
+        for user_id, username in created:
+            results[candidates[username]] = {"username": username, "status": "created", "id": user_id}
+            created_count += 1
+    db.session.commit()
+
+    # Rows skipped by ON CONFLICT were registered concurrently by someone else
+    for username, index in candidates.items():
+        if results[index] is None:
+            results[index] = {"username": username, "status": "exists", "msg": "Username already exists"}
+    remember_taken_usernames(list(existing) + usernames)
+
+    return jsonify({
+        "created": created_count,
+        "results": results
+    }), 200
+
 # Login endpoint with password hashing verification
 @app.route('/auth/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
+
+    # Throttle every attempt per client IP and failed attempts per username,
+    # before any database lookup or hash check
+    retry_after = login_username_throttle.retry_after(username) or login_ip_throttle.hit(request.remote_addr)
+    if retry_after:
+        response = jsonify({"msg": "Too many login attempts, try again later"})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
     
     # Find user
     user = User.query.filter_by(username=username).first()
     
-    if not user or not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+    if not user or not hash_pool.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+        login_username_throttle.hit(username)
         return jsonify({"msg": "Invalid credentials"}), 401
+
+    # Rehash passwords stored with a different cost factor than the current one
+    if hash_rounds(user.password) != bcrypt_rounds:
+        try:
+            user.password = hash_pool.hashpw(password.encode('utf-8'), bcrypt.gensalt(bcrypt_rounds)).decode('utf-8')
+            db.session.commit()
+        except HashPoolBusy:
+            pass  # Try again on a later login
     
     # Create access token
     access_token = create_access_token(identity=user.id)
@@ -98,9 +285,37 @@ def get_user():
         "created_at": user.created_at
     })
 
+def stream_users(after):
+    # Rows come from a server-side cursor in chunks, so memory stays flat whatever the table size
+    rows = db.session.execute(
+        db.select(User.id, User.username, User.created_at)
+        .where(User.id > after)
+        .order_by(User.id)
+        .execution_options(stream_results=True, yield_per=1000)
+    )
+    try:
+        for row in rows:
+            yield app.json.dumps({
+                "id": row.id,
+                "username": row.username,
+                "created_at": row.created_at
+            }) + '\n'
+    finally:
+        # Release the cursor and its transaction as soon as the stream ends
+        db.session.close()
+
 @app.route('/auth/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
+    # Keyset pagination: "after" is the last user id of the previous page
+    limit = request.args.get('limit', 100, type=int)
+    after = request.args.get('after', 0, type=int)
+    if limit < 1 or limit > 1000:
+        return jsonify({"msg": "limit must be between 1 and 1000"}), 400
+
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        return Response(stream_with_context(stream_users(after)), mimetype='application/x-ndjson')
+
+    users = User.query.filter(User.id > after).order_by(User.id).limit(limit).all()
     
     # Create a list of dictionaries for each user
     users_list = []
@@ -110,10 +325,12 @@ def get_users():
             "username": user.username,
             "created_at": user.created_at
         })
+
+    next_cursor = users[-1].id if len(users) == limit else None
     
-    return jsonify(users=users_list), 200
+    return jsonify(users=users_list, next_cursor=next_cursor), 200
 
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(debug=True, port=5050)
+    create_app().run(debug=True, port=5050)
     register_with_consul("auth-service", "auth-service-id", 5050)  # For auth_service
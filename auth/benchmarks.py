@@ -0,0 +1,130 @@
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+# Load benchmarks for a running auth-app.
+# Usage: python benchmarks.py register --url http://localhost:5050 --users 2000
+#        python benchmarks.py login-attack --url http://localhost:5050 --attackers 16
+# login-attack sends X-Forwarded-For client IPs, so run auth-app with TRUSTED_PROXIES=1.
+# Both import users through /auth/register/batch: pass auth-app's REGISTER_BATCH_TOKEN as --import-token.
+
+
+def register_benchmark(args):
+    prefix = uuid.uuid4().hex[:8]
+    http = requests.Session()
+
+    # Current path: one /auth/register call per user
+    start = time.perf_counter()
+    for index in range(args.users):
+        http.post(f'{args.url}/auth/register', json={
+            "username": f'{prefix}-single-{index}',
+            "password": f'password-{index}'
+        })
+    single_time = time.perf_counter() - start
+
+    # Bulk path: /auth/register/batch with --batch-size users per call
+    start = time.perf_counter()
+    created = 0
+    for offset in range(0, args.users, args.batch_size):
+        response = http.post(f'{args.url}/auth/register/batch', json={"users": [
+            {"username": f'{prefix}-batch-{index}', "password": f'password-{index}'}
+            for index in range(offset, min(offset + args.batch_size, args.users))
+        ]}, headers={"X-Import-Token": args.import_token})
+        created += response.json()["created"]
+    batch_time = time.perf_counter() - start
+
+    print(f'per-user /auth/register: {args.users} users in {single_time:.2f}s ({args.users / single_time:.1f} users/s)')
+    print(f'/auth/register/batch:    {created} users in {batch_time:.2f}s ({created / batch_time:.1f} users/s)')
+    print(f'speedup:                 {single_time / batch_time:.1f}x')
+
+
+def measure_logins(url, username, password, count):
+    # Login latencies in ms of a legitimate user on its own client IP
+    http = requests.Session()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = http.post(f'{url}/auth/login', json={"username": username, "password": password},
+                             headers={"X-Forwarded-For": "10.255.255.1"})
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+        time.sleep(0.05)
+    return latencies
+
+
+def attacker(url, victims, addresses, stop, statuses):
+    # Credential stuffing: wrong passwords for real usernames from a pool of client IPs
+    http = requests.Session()
+    while not stop.is_set():
+        response = http.post(f'{url}/auth/login', json={
+            "username": random.choice(victims),
+            "password": uuid.uuid4().hex
+        }, headers={"X-Forwarded-For": random.choice(addresses)})
+        statuses[response.status_code] += 1
+
+
+def login_attack_benchmark(args):
+    prefix = uuid.uuid4().hex[:8]
+    username = f'{prefix}-legit'
+    victims = [f'{prefix}-victim-{index}' for index in range(args.victims)]
+    requests.post(f'{args.url}/auth/register/batch', json={"users": [
+        {"username": name, "password": "correct-password"} for name in [username] + victims
+    ]}, headers={"X-Import-Token": args.import_token})
+
+    baseline = measure_logins(args.url, username, "correct-password", args.logins)
+
+    stop = threading.Event()
+    statuses = Counter()
+    addresses = [f'10.0.{index // 250}.{index % 250 + 1}' for index in range(args.addresses)]
+    attackers = [threading.Thread(target=attacker, args=(args.url, victims, addresses, stop, statuses))
+                 for _ in range(args.attackers)]
+    for thread in attackers:
+        thread.start()
+    time.sleep(args.warmup)
+    under_attack = measure_logins(args.url, username, "correct-password", args.logins)
+    stop.set()
+    for thread in attackers:
+        thread.join()
+
+    for name, latencies in [("no attack", baseline), ("under attack", under_attack)]:
+        latencies = sorted(latencies)
+        print(f'legit login {name:13} p50 {statistics.median(latencies):7.1f} ms   '
+              f'p95 {latencies[int(len(latencies) * 0.95) - 1]:7.1f} ms')
+    print(f'attacker responses: {dict(statuses)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='auth-app benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    register = subparsers.add_parser('register', help='per-user registration against the batch endpoint')
+    register.add_argument('--url', default='http://localhost:5050')
+    register.add_argument('--import-token', default=os.getenv('REGISTER_BATCH_TOKEN', ''))
+    register.add_argument('--users', type=int, default=1000)
+    register.add_argument('--batch-size', type=int, default=1000)
+
+    login_attack = subparsers.add_parser('login-attack', help='legitimate login latency during a credential-stuffing attack')
+    login_attack.add_argument('--url', default='http://localhost:5050')
+    login_attack.add_argument('--import-token', default=os.getenv('REGISTER_BATCH_TOKEN', ''))
+    login_attack.add_argument('--attackers', type=int, default=16, help='concurrent attacking threads')
+    login_attack.add_argument('--victims', type=int, default=10, help='attacked usernames')
+    login_attack.add_argument('--addresses', type=int, default=5, help='attacking client IPs')
+    login_attack.add_argument('--logins', type=int, default=50, help='legitimate logins measured per phase')
+    login_attack.add_argument('--warmup', type=float, default=15, help='seconds of attack before measuring')
+
+    args = parser.parse_args()
+    if args.benchmark == 'register':
+        register_benchmark(args)
+    elif args.benchmark == 'login-attack':
+        login_attack_benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class HashPoolBusy(Exception):
+    # Raised when every worker is busy and the queue of waiting hash jobs is full
+    def __init__(self, retry_after):
+        super().__init__("bcrypt pool is saturated")
+        self.retry_after = retry_after
+
+
+def hash_rounds(hashed_password):
+    # Cost factor stored in a bcrypt hash, e.g. 12 for "$2b$12$..."
+    return int(hashed_password.split('$')[2])
+
+
+def calibrate_rounds(target_ms, min_rounds=10, max_rounds=16):
+    # Each extra round doubles the hash time, so time a few cheap hashes and
+    # extrapolate to the cost whose hash time is closest to the target
+    sample_rounds = 6
+    samples = []
+    for _ in range(3):
+        started_at = time.perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(sample_rounds))
+        samples.append(time.perf_counter() - started_at)
+    sample_ms = max(min(samples) * 1000, 0.01)
+
+    rounds = sample_rounds + round(math.log2(target_ms / sample_ms))
+    return max(min_rounds, min(max_rounds, rounds))
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class HashPool:
+    # Runs bcrypt off the request thread on a fixed number of threads.
+    # bcrypt releases the GIL while hashing, so the threads use every core.
+
+    def __init__(self, workers, max_queue, samples=1000):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._hash_times = deque(maxlen=samples)
+        self._wait_times = deque(maxlen=samples)
+
+    def _run(self, func, args, submitted_at):
+        started_at = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            finished_at = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                self._completed += 1
+                self._wait_times.append(started_at - submitted_at)
+                self._hash_times.append(finished_at - started_at)
+            self._slots.release()
+
+    def retry_after(self):
+        # Seconds until the current queue should have drained, at least one
+        with self._lock:
+            hash_time = sum(self._hash_times) / len(self._hash_times) if self._hash_times else 0.25
+        return max(1, math.ceil(hash_time * (self.workers + self.max_queue) / self.workers))
+
+    def submit(self, func, *args, wait=False):
+        if not self._slots.acquire(blocking=wait):
+            with self._lock:
+                self._rejected += 1
+            raise HashPoolBusy(self.retry_after())
+        with self._lock:
+            self._pending += 1
+        return self._executor.submit(self._run, func, args, time.perf_counter())
+
+    def hashpw(self, password, salt):
+        return self.submit(bcrypt.hashpw, password, salt).result()
+
+    def checkpw(self, password, hashed_password):
+        return self.submit(bcrypt.checkpw, password, hashed_password).result()
+
+    def hashpw_many(self, passwords, rounds, concurrency=None):
+        # Bulk jobs wait for free slots instead of failing, and take at most
+        # concurrency slots (one per worker by default) at a time so logins can still queue up
+        concurrency = concurrency or self.workers
+        hashed_passwords = []
+        for start in range(0, len(passwords), concurrency):
+            futures = [self.submit(bcrypt.hashpw, password, bcrypt.gensalt(rounds), wait=True)
+                       for password in passwords[start:start + concurrency]]
+            hashed_passwords += [future.result() for future in futures]
+        return hashed_passwords
+
+    def metrics(self):
+        with self._lock:
+            pending = self._pending
+            hash_times = list(self._hash_times)
+            wait_times = list(self._wait_times)
+            completed = self._completed
+            rejected = self._rejected
+
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": min(pending, self.workers),
+            "queue_depth": max(0, pending - self.workers),
+            "completed": completed,
+            "rejected": rejected,
+            "hash_ms": {
+                "p50": round(percentile(hash_times, 0.50) * 1000, 2),
+                "p95": round(percentile(hash_times, 0.95) * 1000, 2),
+                "p99": round(percentile(hash_times, 0.99) * 1000, 2)
+            },
+            "queue_wait_ms": {
+                "p50": round(percentile(wait_times, 0.50) * 1000, 2),
+                "p95": round(percentile(wait_times, 0.95) * 1000, 2),
+                "p99": round(percentile(wait_times, 0.99) * 1000, 2)
+            }
+        }
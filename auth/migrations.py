@@ -0,0 +1,72 @@
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+# Table recording applied versions, named per service so both can share a test database
+SCHEMA_VERSION_TABLE = 'auth_schema_version'
+
+# Key of the Postgres advisory lock held while migrating, so only one process migrates at a time
+MIGRATION_LOCK_ID = 5050
+
+# Versioned schema migrations, applied in order. Never edit a released one, add a new version instead.
+MIGRATIONS = [
+    (1, "Create users table", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(255) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE
+        );
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    # One query on the hot startup path, 0 when the database was never migrated
+    try:
+        return connection.execute(text(f"SELECT max(version) FROM {SCHEMA_VERSION_TABLE}")).scalar() or 0
+    except ProgrammingError:
+        connection.rollback()
+        return 0
+
+
+def migrate(engine):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        try:
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+                    version INTEGER PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+                )
+            """))
+            connection.commit()
+
+            # Another process may have migrated while we waited for the lock
+            version = current_version(connection)
+            for number, description, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                connection.execute(text(statements))
+                connection.execute(text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) VALUES (:version, :description)"),
+                                   {"version": number, "description": description})
+                connection.commit()
+        finally:
+            connection.rollback()
+            connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            connection.commit()
+
+
+def ensure_schema(engine, auto_migrate):
+    with engine.connect() as connection:
+        version = current_version(connection)
+
+    if version == LATEST_VERSION:
+        return
+    if version > LATEST_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this code ({LATEST_VERSION})")
+    if not auto_migrate:
+        raise RuntimeError(f"Database schema is at version {version}, expected {LATEST_VERSION}. Run 'flask --app auth_service migrate'.")
+    migrate(engine)
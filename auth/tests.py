@@ -1,6 +1,13 @@
+import threading
+import time
+
+import bcrypt
+import fakeredis
 import pytest
 from flask import json
 from auth_service import create_app, db, User
+from hashing import HashPool, calibrate_rounds, hash_rounds
+from throttling import MemorySlidingWindow, RedisSlidingWindow
 
 @pytest.fixture
 def client():
@@ -104,4 +111,208 @@ def test_jwt_protected_endpoint(client):
     })
     data = response.get_json()
 
-    assert response.status_code == 422
\ No newline at end of file
+    assert response.status_code == 422
+
+def test_users_pagination(client):
+    for index in range(5):
+        client.post('/auth/register', json={
+            "username": f"user{index}",
+            "password": "password123"
+        })
+
+    # Test first page
+    response = client.get('/auth/users?limit=2')
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert [user["username"] for user in data["users"]] == ["user0", "user1"]
+    assert data["next_cursor"] == data["users"][-1]["id"]
+
+    # Test following pages until the cursor runs out
+    usernames = [user["username"] for user in data["users"]]
+    while data["next_cursor"] is not None:
+        data = client.get(f'/auth/users?limit=2&after={data["next_cursor"]}').get_json()
+        usernames += [user["username"] for user in data["users"]]
+
+    assert usernames == [f"user{index}" for index in range(5)]
+
+    # Test NDJSON streaming mode
+    response = client.get('/auth/users?format=ndjson')
+    lines = response.get_data(as_text=True).splitlines()
+    response.close()
+
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line)["username"] for line in lines] == [f"user{index}" for index in range(5)]
+
+def test_sliding_window_throttles():
+    now = [1000.0]
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        for window in (MemorySlidingWindow(limit=2, window=60),
+                       RedisSlidingWindow(fakeredis.FakeStrictRedis(), 'test', limit=2, window=60)):
+            assert window.hit('1.2.3.4') == 0
+            now[0] += 10
+            assert window.hit('1.2.3.4') == 0 and window.retry_after('1.2.3.4') == 50
+            # A rejected attempt counts too, so hammering keeps the client out
+            assert window.hit('1.2.3.4') == 60 and window.retry_after('5.6.7.8') == 0
+
+            now[0] += 61
+            assert window.retry_after('1.2.3.4') == 0
+            now[0] += 100
+
+def test_login_throttled(client, monkeypatch):
+    import auth_service
+
+    monkeypatch.setattr(auth_service, 'login_ip_throttle', MemorySlidingWindow(limit=2, window=60))
+    client.post('/auth/register', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    for _ in range(2):
+        response = client.post('/auth/login', json={
+            "username": "testuser",
+            "password": "password123"
+        })
+        assert response.status_code == 200
+
+    response = client.post('/auth/login', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+    # Behind the gateway each client IP gets its own window
+    response = client.post('/auth/login', json={
+        "username": "testuser",
+        "password": "password123"
+    }, environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert response.status_code == 200
+
+def test_register_batch(client, monkeypatch):
+    import auth_service
+
+    users = [
+        {"username": "newuser", "password": "password123"},
+        {"username": "takenuser", "password": "password123"},
+        {"username": "newuser", "password": "password456"},
+        {"username": "nopassword"},
+        {"username": ["not", "a", "string"], "password": "password123"},
+        "not a user"
+    ]
+    client.post('/auth/register', json={
+        "username": "takenuser",
+        "password": "password123"
+    })
+
+    # Only operators holding the import token may import users
+    monkeypatch.setattr(auth_service, 'REGISTER_BATCH_TOKEN', None)
+    assert client.post('/auth/register/batch', json={"users": users}).status_code == 403
+    monkeypatch.setattr(auth_service, 'REGISTER_BATCH_TOKEN', 'import-secret')
+    assert client.post('/auth/register/batch', json={"users": users},
+                       headers={"X-Import-Token": "wrong"}).status_code == 403
+
+    headers = {"X-Import-Token": "import-secret"}
+    assert client.post('/auth/register/batch', json={"users": "newuser"}, headers=headers).status_code == 400
+
+    response = client.post('/auth/register/batch', json={"users": users}, headers=headers)
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert data["created"] == 1
+    assert [result["status"] for result in data["results"]] == \
+        ["created", "exists", "duplicate", "invalid", "invalid", "invalid"]
+
+    response = client.post('/auth/login', json={
+        "username": "newuser",
+        "password": "password123"
+    })
+    assert response.status_code == 200
+
+def test_register_conflict(client):
+    # A username inserted behind the service's back is caught by ON CONFLICT, not a pre-check
+    with client.application.app_context():
+        db.session.add(User(username="testuser", password=bcrypt.hashpw(b"password123", bcrypt.gensalt(4)).decode('utf-8')))
+        db.session.commit()
+
+    response = client.post('/auth/register', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+
+    assert response.status_code == 409
+    assert response.get_json()['msg'] == "Username already exists"
+
+def test_username_precheck(client, monkeypatch):
+    import auth_service
+
+    monkeypatch.setattr(auth_service, 'USERNAME_PRECHECK', True)
+    monkeypatch.setattr(auth_service, 'redis_client', fakeredis.FakeStrictRedis())
+    client.post('/auth/register', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    assert auth_service.redis_client.sismember(auth_service.TAKEN_USERNAMES_KEY, "testuser")
+
+    # A known username is rejected without hashing or touching the database
+    def no_hashing(*args):
+        raise AssertionError("hashed a password for a taken username")
+    monkeypatch.setattr(auth_service.hash_pool, 'hashpw', no_hashing)
+    response = client.post('/auth/register', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+
+    assert response.status_code == 409
+    assert response.get_json()['msg'] == "Username already exists"
+
+def test_hash_pool_saturated(client, monkeypatch):
+    import auth_service
+
+    pool = HashPool(workers=1, max_queue=0)
+    monkeypatch.setattr(auth_service, 'hash_pool', pool)
+    release = threading.Event()
+    blocker = pool.submit(release.wait)
+    try:
+        response = client.post('/auth/register', json={
+            "username": "testuser",
+            "password": "password123"
+        })
+    finally:
+        release.set()
+        blocker.result()
+
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert pool.metrics()["rejected"] == 1
+
+def test_calibrate_rounds_clamped():
+    assert calibrate_rounds(target_ms=0.001, min_rounds=10, max_rounds=16) == 10
+    assert calibrate_rounds(target_ms=10 ** 9, min_rounds=10, max_rounds=16) == 16
+
+def test_login_rehashes(client, monkeypatch):
+    import auth_service
+
+    client.post('/auth/register', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    with client.application.app_context():
+        stored_rounds = hash_rounds(User.query.filter_by(username="testuser").first().password)
+
+    # A login after the cost factor changed stores the password with the new one
+    monkeypatch.setattr(auth_service, 'bcrypt_rounds', stored_rounds + 1)
+    response = client.post('/auth/login', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    assert response.status_code == 200
+
+    with client.application.app_context():
+        assert hash_rounds(User.query.filter_by(username="testuser").first().password) == stored_rounds + 1
+
+    response = client.post('/auth/login', json={
+        "username": "testuser",
+        "password": "password123"
+    })
+    assert response.status_code == 200
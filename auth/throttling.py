@@ -0,0 +1,105 @@
+import math
+import threading
+import time
+import uuid
+from collections import deque
+
+import redis
+
+
+class MemorySlidingWindow:
+    # A deque of attempt times per key, pruned as attempts leave the window
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+
+    def _prune(self, key, now):
+        attempts = self._attempts.get(key)
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        return attempts
+
+    def _sweep(self, now):
+        # Drop keys whose attempts all left the window, e.g. usernames tried once
+        for key in list(self._attempts):
+            if not self._prune(key, now):
+                del self._attempts[key]
+
+    def retry_after(self, key):
+        # Seconds until the next attempt is allowed, 0 when it is allowed now
+        now = time.time()
+        with self._lock:
+            attempts = self._prune(key, now)
+            if not attempts or len(attempts) < self.limit:
+                return 0
+            return max(1, math.ceil(attempts[-self.limit] + self.window - now))
+
+    def hit(self, key):
+        # Record an attempt and return retry_after including it
+        now = time.time()
+        with self._lock:
+            self._hits += 1
+            if self._hits % 10000 == 0:
+                self._sweep(now)
+            attempts = self._prune(key, now)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            attempts.append(now)
+            if len(attempts) <= self.limit:
+                return 0
+            return max(1, math.ceil(attempts[-self.limit] + self.window - now))
+
+
+class RedisSlidingWindow:
+    # One sorted set per key, scored by attempt time. Falls back to a MemorySlidingWindow
+    # while Redis is down.
+
+    def __init__(self, redis_client, prefix, limit, window):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+        self.fallback = MemorySlidingWindow(limit, window)
+
+    def retry_after(self, key):
+        now = time.time()
+        name = f'{self.prefix}:{key}'
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.zremrangebyscore(name, 0, now - self.window)
+            pipeline.zrevrange(name, self.limit - 1, self.limit - 1, withscores=True)
+            _, oldest = pipeline.execute()
+        except redis.RedisError:
+            return self.fallback.retry_after(key)
+
+        if not oldest:
+            return 0
+        return max(1, math.ceil(oldest[0][1] + self.window - now))
+
+    def hit(self, key):
+        now = time.time()
+        name = f'{self.prefix}:{key}'
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.zremrangebyscore(name, 0, now - self.window)
+            pipeline.zadd(name, {uuid.uuid4().hex: now})
+            pipeline.expire(name, math.ceil(self.window))
+            pipeline.zcard(name)
+            pipeline.zrevrange(name, self.limit - 1, self.limit - 1, withscores=True)
+            _, _, _, count, oldest = pipeline.execute()
+        except redis.RedisError:
+            return self.fallback.hit(key)
+
+        if count <= self.limit:
+            return 0
+        return max(1, math.ceil(oldest[0][1] + self.window - now))
+
+
+def sliding_window(redis_client, prefix, limit, window):
+    if redis_client is None:
+        return MemorySlidingWindow(limit, window)
+    return RedisSlidingWindow(redis_client, prefix, limit, window)
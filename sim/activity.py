@@ -0,0 +1,76 @@
+import threading
+import time
+
+import redis
+from sortedcontainers import SortedList
+
+
+class MemoryActivity:
+    # Last activity time per session, also kept ordered by time to find the idle ones
+
+    def __init__(self):
+        self._by_time = SortedList()  # (last_active, session_id)
+        self._last_active = {}
+        self._lock = threading.Lock()
+
+    def _set(self, session_id, at):
+        previous = self._last_active.get(session_id)
+        if previous is not None:
+            self._by_time.remove((previous, session_id))
+        self._last_active[session_id] = at
+        self._by_time.add((at, session_id))
+
+    def touch(self, session_id, at=None):
+        with self._lock:
+            self._set(int(session_id), at or time.time())
+
+    def touch_missing(self, activity):
+        # Seed (session_id, last_active) pairs for sessions not tracked yet
+        with self._lock:
+            for session_id, at in activity:
+                if session_id not in self._last_active:
+                    self._set(session_id, at)
+
+    def idle(self, before, limit):
+        # Up to limit sessions last active before the given time, oldest first
+        with self._lock:
+            return [session_id for _, session_id in self._by_time.irange(maximum=(before, float('inf')))][:limit]
+
+    def forget(self, session_ids):
+        with self._lock:
+            for session_id in session_ids:
+                at = self._last_active.pop(int(session_id), None)
+                if at is not None:
+                    self._by_time.remove((at, int(session_id)))
+
+
+class RedisActivity:
+    # One sorted set of session ids scored by last activity time
+
+    def __init__(self, redis_client, key='sessions:activity'):
+        self.redis = redis_client
+        self.key = key
+
+    def touch(self, session_id, at=None):
+        try:
+            self.redis.zadd(self.key, {session_id: at or time.time()})
+        except redis.RedisError:
+            pass  # The session just looks idle earlier than it is
+
+    def touch_missing(self, activity):
+        mapping = dict(activity)
+        if mapping:
+            self.redis.zadd(self.key, mapping, nx=True)
+
+    def idle(self, before, limit):
+        return [int(session_id) for session_id in self.redis.zrangebyscore(self.key, '-inf', before, start=0, num=limit)]
+
+    def forget(self, session_ids):
+        if session_ids:
+            self.redis.zrem(self.key, *session_ids)
+
+
+def activity_tracker(redis_client, key='sessions:activity'):
+    if redis_client is None:
+        return MemoryActivity()
+    return RedisActivity(redis_client, key)
@@ -0,0 +1,447 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import uuid
+
+import aiohttp
+import jwt
+import socketio
+
+# Load benchmarks for a running sim-app node.
+# Usage: python benchmarks.py connections --url http://localhost:5000 --clients 5000 --room-size 10
+#        python benchmarks.py tick --sessions 100000 [--database-uri postgresql://...]
+#        python benchmarks.py reconnect --url http://localhost:5000 --clients 10000 --room-size 10
+#        python benchmarks.py encoding --repeat 20000
+#        python benchmarks.py match --url http://localhost:5000 --servants 10000 --princesses 2000
+# The client machine needs a high enough open files limit (ulimit -n) for the number of clients.
+# Chat benchmarks send faster than the default rate limits allow: run the node with
+# SOCKET_MESSAGE_RATE, SOCKET_MESSAGE_BURST, ROOM_MESSAGE_RATE and ROOM_MESSAGE_BURST raised.
+
+
+def make_token(user_id, secret):
+    now = int(time.time())
+    return jwt.encode({
+        "sub": user_id,
+        "type": "access",
+        "fresh": False,
+        "jti": str(uuid.uuid4()),
+        "iat": now,
+        "nbf": now,
+        "exp": now + 3600
+    }, secret, algorithm="HS256")
+
+
+async def seed_room(http, url, princess_user_id, servant_user_id, secret):
+    # One princess and one servant character with a session between them
+    princess_token = make_token(princess_user_id, secret)
+    servant_token = make_token(servant_user_id, secret)
+
+    await http.post(f'{url}/simulation/add_user', json={"is_princess": True},
+                    headers={"Authorization": f'Bearer {princess_token}'})
+    async with http.post(f'{url}/simulation/add_user', json={"is_princess": False},
+                         headers={"Authorization": f'Bearer {servant_token}'}) as response:
+        servant_id = (await response.json())["servant_id"]
+    async with http.post(f'{url}/simulation/session/start', json={"servant_id": servant_id},
+                         headers={"Authorization": f'Bearer {princess_token}'}) as response:
+        session_id = (await response.json())["session_id"]
+
+    return session_id, [princess_token, servant_token]
+
+
+def process_cpu_seconds(pid):
+    # User plus system CPU time of a local process, from /proc (Linux)
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def open_client(url, session_id, token, handshakes, counters, batch=False):
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('message')
+    async def on_message(text, seq=None):
+        counters["delivered"] += 1
+
+    @client.on('batch')
+    async def on_batch(data):
+        counters["frames"] += 1
+        counters["delivered"] += sum(1 for event in data["events"] if event["event"] == 'message')
+
+    @client.on('throttled')
+    async def on_throttled(data):
+        counters["throttled"] += 1
+
+    async with handshakes:
+        try:
+            await client.connect(f'{url}?room_id={session_id}' + ('&batch=1' if batch else ''),
+                                 headers={"Authorization": f'Bearer {token}'}, transports=['websocket'], wait_timeout=30)
+            await client.emit('join_room', {})
+        except socketio.exceptions.ConnectionError:
+            counters["failed"] += 1
+            return None
+    return client
+
+
+async def connections_benchmark(args):
+    rooms = max(1, args.clients // args.room_size)
+    counters = {"delivered": 0, "failed": 0, "throttled": 0, "frames": 0}
+
+    async with aiohttp.ClientSession() as http:
+        seeded = await asyncio.gather(*[
+            seed_room(http, args.url, args.first_user_id + 2 * index, args.first_user_id + 2 * index + 1, args.secret)
+            for index in range(rooms)
+        ])
+
+    # Open every client, at most --handshakes at a time
+    handshakes = asyncio.Semaphore(args.handshakes)
+    start = time.perf_counter()
+    clients = await asyncio.gather(*[
+        open_client(args.url, session_id, tokens[index % 2], handshakes, counters, args.batch)
+        for session_id, tokens in seeded
+        for index in range(args.room_size)
+    ])
+    connect_time = time.perf_counter() - start
+    clients = [client for client in clients if client is not None]
+    await asyncio.sleep(1)
+    counters["delivered"] = counters["frames"] = 0
+
+    # Every client sends --messages chat messages to its room
+    expected = len(clients) * args.messages * args.room_size
+    client_cpu = time.process_time()
+    server_cpu = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    start = time.perf_counter()
+    for message_index in range(args.messages):
+        await asyncio.gather(*[client.emit('send_message', {"message": f'message {message_index}'})
+                               for client in clients])
+    deadline = time.perf_counter() + args.timeout
+    while counters["delivered"] < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    message_time = time.perf_counter() - start
+    client_cpu = time.process_time() - client_cpu
+    if server_cpu is not None:
+        server_cpu = process_cpu_seconds(args.server_pid) - server_cpu
+
+    print(f'broadcast batching:     {"on" if args.batch else "off"}')
+    print(f'connected clients:      {len(clients)} ({counters["failed"]} failed) in {connect_time:.2f}s '
+          f'({len(clients) / connect_time:.0f} connections/s)')
+    print(f'messages sent:          {len(clients) * args.messages} '
+          f'({len(clients) * args.messages / message_time:.0f} messages/s)')
+    print(f'messages delivered:     {counters["delivered"]} of {expected} in {message_time:.2f}s '
+          f'({counters["delivered"] / message_time:.0f} deliveries/s)')
+    print(f'messages throttled:     {counters["throttled"]}')
+    delivered = max(counters["delivered"], 1)
+    if args.batch:
+        print(f'batch frames:           {counters["frames"]} ({counters["delivered"] / max(counters["frames"], 1):.1f} messages per frame)')
+    print(f'client CPU:             {client_cpu / delivered * 1e6:.1f} us per delivered message')
+    if server_cpu is not None:
+        print(f'server CPU:             {server_cpu / delivered * 1e6:.1f} us per delivered message')
+
+    await asyncio.gather(*[client.disconnect() for client in clients])
+
+
+class ResumingClient:
+    # A chat client that remembers the last message sequence number it saw, to resume from it
+
+    def __init__(self, url, session_id, token):
+        self.url = url
+        self.session_id = session_id
+        self.token = token
+        self.last_seq = 0
+        self.received = 0
+        self.client = None
+
+    async def connect(self, handshakes, counters):
+        self.client = socketio.AsyncClient(reconnection=False)
+
+        @self.client.on('message')
+        async def on_message(text, seq=None):
+            self.received += 1
+            self.last_seq = max(self.last_seq, seq or 0)
+
+        async with handshakes:
+            try:
+                await self.client.connect(f'{self.url}?room_id={self.session_id}',
+                                          headers={"Authorization": f'Bearer {self.token}'},
+                                          transports=['websocket'], wait_timeout=30)
+            except socketio.exceptions.ConnectionError:
+                counters["failed"] += 1
+                return False
+        return True
+
+    async def rejoin(self, handshakes, counters, latencies):
+        # Reconnect, join the room again and replay what was missed in between
+        after = self.last_seq
+        if not await self.connect(handshakes, counters):
+            return
+        await self.client.emit('join_room', {})
+        start = time.perf_counter()
+        result = await self.client.call('resume', {"after": after}, timeout=60)
+        latencies.append(time.perf_counter() - start)
+        counters["replayed"] += result["replayed"]
+        counters["incomplete"] += not result["complete"]
+
+
+async def reconnect_benchmark(args):
+    rooms = max(1, args.clients // args.room_size)
+    counters = {"failed": 0, "replayed": 0, "incomplete": 0}
+
+    async with aiohttp.ClientSession() as http:
+        seeded = await asyncio.gather(*[
+            seed_room(http, args.url, args.first_user_id + 2 * index, args.first_user_id + 2 * index + 1, args.secret)
+            for index in range(rooms)
+        ])
+
+    # The first client of every room stays connected and keeps chatting while the others drop
+    handshakes = asyncio.Semaphore(args.handshakes)
+    clients = [ResumingClient(args.url, session_id, tokens[index % 2])
+               for session_id, tokens in seeded for index in range(args.room_size)]
+    connected = await asyncio.gather(*[client.connect(handshakes, counters) for client in clients])
+    clients = [client for client, ok in zip(clients, connected) if ok]
+    await asyncio.gather(*[client.client.emit('join_room', {}) for client in clients])
+    senders = {}
+    for client in clients:
+        senders.setdefault(client.session_id, client)
+    await asyncio.sleep(1)
+
+    dropped = [client for client in clients if senders[client.session_id] is not client]
+    await asyncio.gather(*[client.client.disconnect() for client in dropped])
+    for message_index in range(args.missed):
+        await asyncio.gather(*[sender.client.emit('send_message', {"message": f'missed {message_index}'})
+                               for sender in senders.values()])
+    await asyncio.sleep(1)
+
+    # Every dropped client comes back at once
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client.rejoin(handshakes, counters, latencies) for client in dropped])
+    storm_time = time.perf_counter() - start
+
+    latencies.sort()
+    expected = len(dropped) * args.missed
+    print(f'reconnected clients:    {len(latencies)} of {len(dropped)} ({counters["failed"]} failed) in {storm_time:.2f}s '
+          f'({len(latencies) / storm_time:.0f} reconnects/s)')
+    print(f'messages replayed:      {counters["replayed"]} (at least {expected} missed, '
+          f'{counters["incomplete"]} resumes past the history cap)')
+    if latencies:
+        print(f'resume latency:         p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+
+    await asyncio.gather(*[client.client.disconnect() for client in clients])
+
+
+async def post(http, url, token, limit, json=None):
+    async with limit:
+        async with http.post(url, json=json or {}, headers={"Authorization": f'Bearer {token}'}) as response:
+            return response.status, await response.json()
+
+
+async def match_benchmark(args):
+    servant_tokens = [make_token(args.first_user_id + index, args.secret) for index in range(args.servants)]
+    princess_tokens = [make_token(args.first_user_id + args.servants + index, args.secret)
+                       for index in range(args.princesses)]
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as http:
+        # Seed the characters and put every servant in the queue
+        await asyncio.gather(*[post(http, f'{args.url}/simulation/add_user', token, limit, {"is_princess": False})
+                               for token in servant_tokens])
+        await asyncio.gather(*[post(http, f'{args.url}/simulation/add_user', token, limit, {"is_princess": True})
+                               for token in princess_tokens])
+        await asyncio.gather(*[post(http, f'{args.url}/simulation/servant/available', token, limit)
+                               for token in servant_tokens])
+
+        # Every princess asks for a match at once
+        start = time.perf_counter()
+        results = await asyncio.gather(*[post(http, f'{args.url}/simulation/session/match', token, limit)
+                                         for token in princess_tokens])
+        match_time = time.perf_counter() - start
+
+    matched = [data["servant_id"] for status, data in results if status == 201]
+    print(f'waiting servants:  {args.servants}')
+    print(f'matches:           {len(matched)} of {args.princesses} in {match_time:.2f}s '
+          f'({len(matched) / match_time:.0f} matches/s)')
+    print(f'double bookings:   {len(matched) - len(set(matched))}')
+
+
+def typical_room_events():
+    # Room events as sim_service broadcasts them, {"event", "args"} like the packed event
+    requests = [{"request_id": 1000 + index, "task_id": 7, "task_name": "Fetch tea", "timestamp": "2024-10-18T10:00:00"}
+                for index in range(10)]
+    events = {
+        "chat message": {"event": "message", "args": ["Princess: Bring me tea and cake, please", 4211]},
+        "mood tick": {"event": "mood_changed", "args": [{"mood": 57, "session_id": 81234, "seq": 4212}]},
+        "task completed": {"event": "task_completed",
+                           "args": [{"request_ids": [1000, 1001, 1002], "success": True, "session_id": 81234, "seq": 4213}]},
+        "10 task requests": {"event": "task_requested",
+                             "args": [{"requests": requests, "session_id": 81234, "seq": 4214}]},
+    }
+    events["batch of 20 events"] = {"event": "batch", "args": [{"events": [
+        events["mood tick"], events["chat message"], events["task completed"], events["mood tick"]] * 5}]}
+    return events
+
+
+def encoding_benchmark(args):
+    import json
+    import timeit
+
+    import msgpack
+
+    print(f'{"event":<20} {"JSON bytes":>10} {"msgpack":>8} {"JSON enc/dec us":>16} {"msgpack enc/dec us":>19}')
+    for name, event in typical_room_events().items():
+        encoded_json = json.dumps(event, separators=(',', ':')).encode()
+        encoded_msgpack = msgpack.packb(event)
+
+        def per_call(statement):
+            return min(timeit.repeat(statement, number=args.repeat, repeat=3)) / args.repeat * 1e6
+
+        json_times = per_call(lambda: json.dumps(event, separators=(',', ':'))), per_call(lambda: json.loads(encoded_json))
+        msgpack_times = per_call(lambda: msgpack.packb(event)), per_call(lambda: msgpack.unpackb(encoded_msgpack))
+        print(f'{name:<20} {len(encoded_json):>10} {len(encoded_msgpack):>8} '
+              f'{json_times[0]:>7.2f}/{json_times[1]:<8.2f} {msgpack_times[0]:>9.2f}/{msgpack_times[1]:<9.2f}')
+
+
+def random_events(sessions, count):
+    events = []
+    for _ in range(count):
+        session_id = random.randrange(sessions)
+        if random.random() < 0.5:
+            events.append({"type": "requests_opened", "session_id": session_id, "count": random.randint(1, 3)})
+        else:
+            events.append({"type": "request_completed", "session_id": session_id, "success": random.random() < 0.9})
+    return events
+
+
+def python_tick(sessions, engine):
+    # Baseline: the same rules applied one session object at a time
+    changed = []
+    for session in sessions:
+        mood = session["mood"] + (session["completed"] * engine.completed_bonus
+                                  - session["failed"] * engine.failed_penalty
+                                  - session["pending"] * engine.pending_penalty)
+        session["mood"] = min(max(mood, 0), engine.max_level)
+        session["skill"] = min(session["skill"] + session["completed"] * engine.skill_per_task, engine.max_level)
+        session["completed"] = session["failed"] = 0
+        if round(session["mood"]) != session["written_mood"]:
+            session["written_mood"] = round(session["mood"])
+            changed.append((session["princess_id"], session["written_mood"]))
+    return changed
+
+
+def tick_benchmark(args):
+    from engine import TickEngine
+
+    sessions = args.sessions
+    engine = TickEngine(capacity=sessions)
+    ids = list(range(sessions))
+    engine.add_sessions(ids, ids, ids, [random.randint(20, 80) for _ in ids], [1] * sessions,
+                        [random.randint(0, 3) for _ in ids])
+    baseline = [{"princess_id": session_id, "mood": float(engine.mood[session_id]), "skill": 1,
+                 "pending": int(engine.pending[session_id]), "completed": 0, "failed": 0,
+                 "written_mood": int(engine.written_mood[session_id])} for session_id in ids]
+
+    apply_times, tick_times, python_times, changed, notices = [], [], [], [], []
+    for _ in range(args.ticks):
+        events = random_events(sessions, args.events)
+        start = time.perf_counter()
+        engine.apply_events(events)
+        apply_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        changes = engine.tick()
+        tick_times.append(time.perf_counter() - start)
+        changed.append(len(changes["moods"][1]))
+        notices.append(len(changes["mood_notices"][0]))
+
+        start = time.perf_counter()
+        python_tick(baseline, engine)
+        python_times.append(time.perf_counter() - start)
+
+    print(f'sessions:                {sessions}, {args.events} events per tick, {args.ticks} ticks')
+    print(f'apply events:            {statistics.median(apply_times) * 1000:8.2f} ms per tick')
+    print(f'vectorized tick:         {statistics.median(tick_times) * 1000:8.2f} ms per tick')
+    print(f'per-session Python tick: {statistics.median(python_times) * 1000:8.2f} ms per tick')
+    print(f'changed moods:           {statistics.median(changed):.0f} per tick')
+    print(f'mood_changed broadcasts: {statistics.median(notices):.0f} per tick')
+
+    if args.database_uri:
+        # Bulk flush of one tick's changes with UPDATE ... FROM unnest into a scratch table
+        from sqlalchemy import create_engine, text
+
+        database = create_engine(args.database_uri)
+        with database.connect() as connection:
+            connection.execute(text("CREATE TEMPORARY TABLE bench_princess (id INTEGER PRIMARY KEY, mood_level INTEGER)"))
+            connection.execute(text("INSERT INTO bench_princess SELECT n, 50 FROM generate_series(0, :last) AS n"),
+                               {"last": sessions - 1})
+            connection.commit()
+            engine.apply_events(random_events(sessions, args.events))
+            _, princess_ids, moods = engine.tick()["moods"]
+            start = time.perf_counter()
+            connection.execute(text("""
+                UPDATE bench_princess SET mood_level = changes.mood_level
+                FROM unnest(:ids, :values) AS changes (id, mood_level)
+                WHERE bench_princess.id = changes.id
+            """), {"ids": princess_ids.tolist(), "values": moods.tolist()})
+            connection.commit()
+            print(f'bulk flush:              {(time.perf_counter() - start) * 1000:8.2f} ms for {len(princess_ids)} rows')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sim-app benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    connections = subparsers.add_parser('connections', help='concurrent WebSocket clients and chat throughput of one node')
+    connections.add_argument('--url', default='http://localhost:5000')
+    connections.add_argument('--secret', default=os.getenv('JWT_SECRET_KEY', 'your_jwt_secret_key'))
+    connections.add_argument('--clients', type=int, default=2000)
+    connections.add_argument('--room-size', type=int, default=10)
+    connections.add_argument('--messages', type=int, default=10, help='messages sent by every client')
+    connections.add_argument('--handshakes', type=int, default=200, help='concurrent connection handshakes')
+    connections.add_argument('--first-user-id', type=int, default=1000000)
+    connections.add_argument('--timeout', type=float, default=60)
+    connections.add_argument('--batch', action='store_true', help='negotiate broadcast batching')
+    connections.add_argument('--server-pid', type=int, help='also report CPU of this local sim-app worker')
+
+    reconnect = subparsers.add_parser('reconnect', help='reconnect storm: clients dropping at once and resuming chat history')
+    reconnect.add_argument('--url', default='http://localhost:5000')
+    reconnect.add_argument('--secret', default=os.getenv('JWT_SECRET_KEY', 'your_jwt_secret_key'))
+    reconnect.add_argument('--clients', type=int, default=10000)
+    reconnect.add_argument('--room-size', type=int, default=10)
+    reconnect.add_argument('--missed', type=int, default=20, help='messages sent to every room while its clients are away')
+    reconnect.add_argument('--handshakes', type=int, default=200, help='concurrent connection handshakes')
+    reconnect.add_argument('--first-user-id', type=int, default=3000000)
+
+    tick = subparsers.add_parser('tick', help='cost of one simulation engine tick')
+    tick.add_argument('--sessions', type=int, default=100000, help='concurrent active sessions')
+    tick.add_argument('--events', type=int, default=10000, help='request events applied per tick')
+    tick.add_argument('--ticks', type=int, default=20)
+    tick.add_argument('--database-uri', help='also time the bulk flush against this Postgres')
+
+    encoding = subparsers.add_parser('encoding', help='payload size and encode/decode CPU of JSON and MessagePack')
+    encoding.add_argument('--repeat', type=int, default=20000, help='encodes and decodes timed per event')
+
+    match = subparsers.add_parser('match', help='matchmaking throughput with many waiting servants')
+    match.add_argument('--url', default='http://localhost:5000')
+    match.add_argument('--secret', default=os.getenv('JWT_SECRET_KEY', 'your_jwt_secret_key'))
+    match.add_argument('--servants', type=int, default=10000, help='servants waiting in the queue')
+    match.add_argument('--princesses', type=int, default=2000, help='concurrent match requests')
+    match.add_argument('--concurrency', type=int, default=50, help='requests in flight')
+    match.add_argument('--first-user-id', type=int, default=2000000)
+
+    args = parser.parse_args()
+    if args.benchmark == 'connections':
+        asyncio.run(connections_benchmark(args))
+    elif args.benchmark == 'reconnect':
+        asyncio.run(reconnect_benchmark(args))
+    elif args.benchmark == 'tick':
+        tick_benchmark(args)
+    elif args.benchmark == 'encoding':
+        encoding_benchmark(args)
+    elif args.benchmark == 'match':
+        asyncio.run(match_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastBatcher:
+    # Room events collected for window seconds and emitted as one batch event per room,
+    # so a burst of small events costs one frame per client instead of one per event.
+    # emit(room, events) sends the batch, events being {"event", "args"} dicts in order.
+    # A room reaching max_events is sent right away.
+
+    def __init__(self, emit, window=0.005, max_events=100):
+        self.emit = emit
+        self.window = window
+        self.max_events = max_events
+        self._pending = {}  # room -> events
+        self._lock = threading.Lock()
+
+    def add(self, room, event, args):
+        with self._lock:
+            events = self._pending.setdefault(room, [])
+            events.append({"event": event, "args": list(args)})
+            full = len(events) >= self.max_events
+            if full:
+                del self._pending[room]
+        if full:
+            self.emit(room, events)
+
+    def flush(self):
+        # Send every pending batch, returns the number of events sent
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for room, events in pending.items():
+            self.emit(room, events)
+        return sum(len(events) for events in pending.values())
+
+    def run(self, sleep):
+        # Background loop sending whatever the rooms produced during the last window
+        while True:
+            sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Sending batched room events failed')
+
+
+class MemoryRoomMembers:
+    # Connections per sub-room on this node, so broadcasts skip sub-rooms nobody joined
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def join(self, room):
+        with self._lock:
+            self._counts[room] = self._counts.get(room, 0) + 1
+
+    def leave(self, room):
+        with self._lock:
+            count = self._counts.get(room, 0) - 1
+            if count > 0:
+                self._counts[room] = count
+            else:
+                self._counts.pop(room, None)
+
+    def active(self, rooms):
+        # The given rooms that have at least one member
+        with self._lock:
+            return {room for room in rooms if room in self._counts}
+
+
+class RedisRoomMembers:
+    # One counter key per room, expiring after key_ttl seconds unless a node with members in
+    # the room refreshes it (run). Counts left behind by a node that died go away with the key
+    # once the room's other members have left.
+    # Lookups are cached on this node for cache_ttl seconds, so broadcasts do not each cost a
+    # round trip. A client that joins on another node can miss up to cache_ttl seconds of
+    # broadcasts in its sub-room, which it gets back with sync and resume.
+
+    def __init__(self, redis_client, prefix='members', cache_ttl=1.0, key_ttl=60):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.cache_ttl = cache_ttl
+        self.key_ttl = key_ttl
+        self._cache = {}  # room -> (active, fetched at)
+        self._local = {}  # room -> members on this node
+        self._lock = threading.Lock()
+
+    def _key(self, room):
+        return f'{self.prefix}:{room}'
+
+    def join(self, room):
+        with self._lock:
+            self._cache[room] = (True, time.monotonic())
+            self._local[room] = self._local.get(room, 0) + 1
+        try:
+            self.redis.pipeline().incr(self._key(room)).expire(self._key(room), self.key_ttl).execute()
+        except redis.RedisError:
+            pass
+
+    def leave(self, room):
+        # The last member deletes the counter, WATCH makes a join in between retry this
+        key = self._key(room)
+
+        def apply(pipeline):
+            count = int(pipeline.get(key) or 0)
+            pipeline.multi()
+            if count <= 1:
+                pipeline.delete(key)
+            else:
+                pipeline.decr(key)
+
+        with self._lock:
+            self._cache.pop(room, None)
+            count = self._local.get(room, 0) - 1
+            if count > 0:
+                self._local[room] = count
+            else:
+                self._local.pop(room, None)
+        try:
+            self.redis.transaction(apply, key)
+        except redis.RedisError:
+            pass
+
+    def active(self, rooms):
+        # Every room counts as active while Redis is down, so nobody misses a broadcast
+        now = time.monotonic()
+        result, missing = set(), []
+        with self._lock:
+            if len(self._cache) > 10000:
+                self._cache = {room: entry for room, entry in self._cache.items() if now - entry[1] < self.cache_ttl}
+            for room in rooms:
+                entry = self._cache.get(room)
+                if entry is None or now - entry[1] >= self.cache_ttl:
+                    missing.append(room)
+                elif entry[0]:
+                    result.add(room)
+        if not missing:
+            return result
+
+        missing = list(dict.fromkeys(missing))
+        try:
+            counts = self.redis.mget([self._key(room) for room in missing])
+        except redis.RedisError:
+            return result | set(missing)
+        with self._lock:
+            for room, count in zip(missing, counts):
+                active = count is not None and int(count) > 0
+                self._cache[room] = (active, now)
+                if active:
+                    result.add(room)
+        return result
+
+    def refresh(self):
+        # Push back the expiry of every room with members on this node. A counter that is gone
+        # (expired, or Redis restarted) is recreated with this node's count.
+        with self._lock:
+            local = dict(self._local)
+        pipeline = self.redis.pipeline(transaction=False)
+        for room, count in local.items():
+            pipeline.set(self._key(room), count, nx=True, ex=self.key_ttl)
+            pipeline.expire(self._key(room), self.key_ttl)
+        pipeline.execute()
+
+    def run(self, sleep):
+        # Background loop refreshing this node's rooms well before their keys expire
+        while True:
+            sleep(self.key_ttl / 3)
+            try:
+                self.refresh()
+            except redis.RedisError:
+                logger.exception('Refreshing room member counts failed')
+
+
+def room_members(redis_client, prefix='members', key_ttl=60):
+    if redis_client is None:
+        return MemoryRoomMembers()
+    return RedisRoomMembers(redis_client, prefix, key_ttl=key_ttl)
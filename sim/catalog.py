@@ -0,0 +1,72 @@
+import hashlib
+import json
+import threading
+import time
+
+import redis
+
+
+class TaskCatalog:
+    # Process-local copy of the tasks table, validated with a dict lookup instead of a query.
+    # Writers bump a version key in Redis, and every process reloads once it sees a newer
+    # version. Without Redis, load_version reads a version from the database instead (a
+    # checksum of the table), which also picks up rows changed directly in the database.
+    # Either way it checks at most once per check_interval seconds.
+
+    def __init__(self, load_tasks, redis_client=None, load_version=None, version_key='tasks:version',
+                 check_interval=1.0):
+        self.load_tasks = load_tasks
+        self.redis = redis_client
+        self.load_version = load_version
+        self.version_key = version_key
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._tasks = None
+        self._etag = None
+        self._version = None
+        self._next_check = 0
+
+    def _remote_version(self):
+        if self.redis is None:
+            return self._version if self.load_version is None else self.load_version()
+        try:
+            return self.redis.get(self.version_key)
+        except redis.RedisError:
+            return self._version  # Keep serving the current copy while Redis is down
+
+    def load(self):
+        with self._lock:
+            # Read the version first, a change made while loading is picked up by the next check
+            version = self._remote_version()
+            tasks = dict(self.load_tasks())
+            body = json.dumps(sorted(tasks.items())).encode('utf-8')
+            self._tasks = tasks
+            self._etag = hashlib.sha1(body).hexdigest()
+            self._version = version
+            self._next_check = time.monotonic() + self.check_interval
+
+    def _refresh(self):
+        if self._tasks is None:
+            self.load()
+        elif time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self.check_interval
+            if self._remote_version() != self._version:
+                self.load()
+
+    def tasks(self):
+        # {task_id: name}
+        self._refresh()
+        return self._tasks
+
+    def etag(self):
+        # ETag of the copy last returned by tasks()
+        return self._etag
+
+    def invalidate(self):
+        # Call after committing a change to the tasks table
+        if self.redis is not None:
+            try:
+                self.redis.incr(self.version_key)
+            except redis.RedisError:
+                pass  # Other processes pick the change up once Redis is back and the key moves again
+        self.load()
@@ -0,0 +1,96 @@
+import logging
+import queue
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ChatBuffer:
+    # Chat messages waiting to be written to Postgres, flushed in batches so a busy room
+    # costs one multi-row INSERT per batch instead of one INSERT per message.
+    # The buffer holds at most max_size messages. When it is full add() waits up to
+    # put_timeout for the flusher to make room and then gives up, so senders slow down
+    # instead of memory growing without bound.
+    # A batch that fails is kept and written again row by row before anything newer. A row
+    # the database rejects is dropped. A transient error (database unreachable, as told by
+    # transient(error)) keeps the row and everything after it for the next pass, however
+    # long the outage lasts: the buffer's bound pushes back on senders meanwhile.
+
+    def __init__(self, write_rows, max_size=10000, batch_size=500, flush_interval=1.0, put_timeout=1.0,
+                 transient=lambda error: False):
+        self.write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.transient = transient
+        self._queue = queue.Queue(maxsize=max_size)
+        self._retry = []  # Rows of a failed batch, written before anything newer
+        self._last_flush = time.monotonic()
+
+    def add(self, row):
+        # False when the buffer stayed full for put_timeout seconds and the message was not taken
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def __len__(self):
+        return self._queue.qsize() + len(self._retry)
+
+    def flush(self):
+        # Write one batch, returns the number of messages written
+        self._last_flush = time.monotonic()
+        if self._retry:
+            return self._flush_retry()
+
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return 0
+        try:
+            self.write_rows(rows)
+        except Exception:
+            self._retry = rows
+            raise
+        return len(rows)
+
+    def _flush_retry(self):
+        rows, self._retry = self._retry, []
+        written = 0
+        for index, row in enumerate(rows):
+            try:
+                self.write_rows([row])
+                written += 1
+            except Exception as error:
+                if self.transient(error):
+                    self._retry = rows[index:]
+                    if not written:
+                        raise
+                    return written
+                logger.error('Dropping chat message the database rejected: %r (%s)', row, error)
+        return written
+
+    def close(self):
+        # Write everything still buffered, on shutdown
+        try:
+            while len(self):
+                self.flush()
+        except Exception:
+            logger.exception('Writing buffered chat messages failed, %s were lost', len(self))
+
+    def run(self, sleep, poll_interval=0.05):
+        # Background loop: flush once a full batch is waiting or flush_interval has passed
+        while True:
+            if len(self) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Chat message flush failed, retrying')
+                    sleep(self.flush_interval)
+            else:
+                sleep(poll_interval)
@@ -0,0 +1,234 @@
+import json
+from collections import deque
+
+import numpy as np
+import redis
+
+
+class MemoryEventQueue:
+    # A deque of simulation events, popped oldest first
+
+    def __init__(self):
+        self._events = deque()
+
+    def push(self, *events):
+        self._events.extend(events)
+
+    def pop(self, count):
+        events = []
+        while self._events and len(events) < count:
+            events.append(self._events.popleft())
+        return events
+
+
+class RedisEventQueue:
+    # One Redis list that every node pushes to and the engine leader pops from
+
+    def __init__(self, redis_client, key='sim:events'):
+        self.redis = redis_client
+        self.key = key
+
+    def push(self, *events):
+        try:
+            self.redis.rpush(self.key, *[json.dumps(event) for event in events])
+        except redis.RedisError:
+            pass  # Counters drift until the next leader reloads them from Postgres
+
+    def pop(self, count):
+        return [json.loads(event) for event in self.redis.lpop(self.key, count) or []]
+
+
+def event_queue(redis_client, key='sim:events'):
+    if redis_client is None:
+        return MemoryEventQueue()
+    return RedisEventQueue(redis_client, key)
+
+
+class TickEngine:
+    # Advances every active session once per tick. Per-session state lives in NumPy arrays
+    # indexed by slot, so a tick is a few vector operations whatever the number of sessions.
+    #
+    # Events (dicts with a "type", a "session_id" and the time "at" they were pushed):
+    #   session_started    princess_id, servant_id, mood, skill
+    #   session_ended
+    #   requests_opened    count
+    #   request_completed  success
+    #
+    # Each tick a princess loses pending_penalty mood per pending request and failed_penalty
+    # per failed one, and gains completed_bonus per completed one. Her servant gains
+    # skill_per_task skill per completed task. Levels stay within 0..max_level.
+    #
+    # Every changed level is reported for writing, but a mood is only reported for notifying
+    # its room when it lands in another band of mood_notify_step points than last notified.
+
+    def __init__(self, capacity=1024, pending_penalty=0.1, failed_penalty=5.0, completed_bonus=2.0,
+                 skill_per_task=1, max_level=100, mood_notify_step=10):
+        self.pending_penalty = pending_penalty
+        self.failed_penalty = failed_penalty
+        self.completed_bonus = completed_bonus
+        self.skill_per_task = skill_per_task
+        self.max_level = max_level
+        self.mood_notify_step = mood_notify_step
+
+        self.slots = {}  # session_id -> slot
+        self.free_slots = []
+        self.size = 0  # High-water mark of used slots
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        def grow(array, dtype):
+            grown = np.zeros(capacity, dtype=dtype)
+            if array is not None:
+                grown[:self.capacity] = array
+            return grown
+
+        self.session_ids = grow(getattr(self, 'session_ids', None), np.int64)
+        self.princess_ids = grow(getattr(self, 'princess_ids', None), np.int64)
+        self.servant_ids = grow(getattr(self, 'servant_ids', None), np.int64)
+        self.active = grow(getattr(self, 'active', None), bool)
+        self.mood = grow(getattr(self, 'mood', None), np.float64)
+        self.skill = grow(getattr(self, 'skill', None), np.int64)
+        self.pending = grow(getattr(self, 'pending', None), np.int64)
+        self.completed = grow(getattr(self, 'completed', None), np.int64)
+        self.failed = grow(getattr(self, 'failed', None), np.int64)
+        # Last values written out, to flush only what changed
+        self.written_mood = grow(getattr(self, 'written_mood', None), np.int64)
+        self.written_skill = grow(getattr(self, 'written_skill', None), np.int64)
+        self.notified_band = grow(getattr(self, 'notified_band', None), np.int64)
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add_sessions(self, session_ids, princess_ids, servant_ids, moods, skills, pending):
+        # Bulk load, used when the engine starts from the sessions in Postgres
+        new = [index for index, session_id in enumerate(session_ids) if session_id not in self.slots]
+        if not new:
+            return
+        count = len(new)
+        if self.size + count > self.capacity:
+            self._allocate(max(self.capacity * 2, self.size + count))
+
+        slots = np.arange(self.size, self.size + count)
+        self.size += count
+        for slot, index in zip(slots.tolist(), new):
+            self.slots[session_ids[index]] = slot
+
+        def take(values):
+            return np.asarray(values)[new]
+
+        self.session_ids[slots] = take(session_ids)
+        self.princess_ids[slots] = take(princess_ids)
+        self.servant_ids[slots] = take(servant_ids)
+        self.active[slots] = True
+        self.mood[slots] = take(moods)
+        self.skill[slots] = take(skills)
+        self.pending[slots] = take(pending)
+        self.completed[slots] = 0
+        self.failed[slots] = 0
+        self.written_mood[slots] = take(moods)
+        self.written_skill[slots] = take(skills)
+        self.notified_band[slots] = np.asarray(take(moods), dtype=np.int64) // self.mood_notify_step
+
+    def add_session(self, session_id, princess_id, servant_id, mood, skill, pending=0):
+        if session_id in self.slots:
+            return
+        if not self.free_slots:
+            self.add_sessions([session_id], [princess_id], [servant_id], [mood], [skill], [pending])
+            return
+        slot = self.free_slots.pop()
+        self.slots[session_id] = slot
+        self.session_ids[slot] = session_id
+        self.princess_ids[slot] = princess_id
+        self.servant_ids[slot] = servant_id
+        self.active[slot] = True
+        self.mood[slot] = self.written_mood[slot] = mood
+        self.skill[slot] = self.written_skill[slot] = skill
+        self.notified_band[slot] = int(mood) // self.mood_notify_step
+        self.pending[slot] = pending
+        self.completed[slot] = self.failed[slot] = 0
+
+    def remove_session(self, session_id):
+        slot = self.slots.pop(session_id, None)
+        if slot is None:
+            return
+        self.active[slot] = False
+        self.pending[slot] = self.completed[slot] = self.failed[slot] = 0
+        self.free_slots.append(slot)
+
+    def apply_events(self, events, snapshot_at=None):
+        # Counter changes are gathered per event and applied with one np.add.at per counter.
+        # Pending counts loaded at snapshot_at already include the requests opened and completed
+        # before it, so events older than that only count as completions.
+        pending_slots, pending_deltas = [], []
+        completed_slots, failed_slots = [], []
+        for event in events:
+            kind = event['type']
+            in_snapshot = snapshot_at is not None and event.get('at', 0) < snapshot_at
+            if kind == 'session_started':
+                self.add_session(event['session_id'], event['princess_id'], event['servant_id'],
+                                 event['mood'], event['skill'])
+                continue
+            if kind == 'session_ended':
+                self.remove_session(event['session_id'])
+                continue
+
+            slot = self.slots.get(event['session_id'])
+            if slot is None:
+                continue
+            if kind == 'requests_opened' and not in_snapshot:
+                pending_slots.append(slot)
+                pending_deltas.append(event['count'])
+            elif kind == 'request_completed':
+                if not in_snapshot:
+                    pending_slots.append(slot)
+                    pending_deltas.append(-1)
+                (completed_slots if event['success'] else failed_slots).append(slot)
+
+        if pending_slots:
+            np.add.at(self.pending, pending_slots, pending_deltas)
+            np.maximum(self.pending, 0, out=self.pending)
+        if completed_slots:
+            np.add.at(self.completed, completed_slots, 1)
+        if failed_slots:
+            np.add.at(self.failed, failed_slots, 1)
+
+    def tick(self):
+        # Advance every session by one tick. Returns the changed levels as
+        # {"moods": (session_ids, princess_ids, values), "skills": (session_ids, servant_ids, values),
+        #  "mood_notices": (session_ids, values)}
+        size = self.size
+        active = self.active[:size]
+        mood = self.mood[:size]
+        skill = self.skill[:size]
+        completed = self.completed[:size]
+
+        mood += (completed * self.completed_bonus
+                 - self.failed[:size] * self.failed_penalty
+                 - self.pending[:size] * self.pending_penalty)
+        np.clip(mood, 0, self.max_level, out=mood)
+        skill += completed * self.skill_per_task
+        np.minimum(skill, self.max_level, out=skill)
+        completed[:] = 0
+        self.failed[:size] = 0
+
+        rounded_mood = np.rint(mood).astype(np.int64)
+        written_mood = self.written_mood[:size]
+        written_skill = self.written_skill[:size]
+        mood_changed = active & (rounded_mood != written_mood)
+        skill_changed = active & (skill != written_skill)
+        written_mood[mood_changed] = rounded_mood[mood_changed]
+        written_skill[skill_changed] = skill[skill_changed]
+
+        band = rounded_mood // self.mood_notify_step
+        notified_band = self.notified_band[:size]
+        band_changed = active & (band != notified_band)
+        notified_band[band_changed] = band[band_changed]
+
+        session_ids = self.session_ids[:size]
+        return {
+            "moods": (session_ids[mood_changed], self.princess_ids[:size][mood_changed], rounded_mood[mood_changed]),
+            "skills": (session_ids[skill_changed], self.servant_ids[:size][skill_changed], skill[skill_changed]),
+            "mood_notices": (session_ids[band_changed], rounded_mood[band_changed])
+        }
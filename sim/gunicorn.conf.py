@@ -0,0 +1,50 @@
+import os
+
+# Production server for sim-app: gunicorn with cooperative gevent workers and WebSocket support
+# Run with: gunicorn -c gunicorn.conf.py 'sim_service:create_app()'
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+
+# Number of worker processes and concurrent connections (greenlets) per worker
+workers = int(os.getenv('SIM_WORKERS', '1'))
+worker_connections = int(os.getenv('SIM_WORKER_CONNECTIONS', '10000'))
+# They share the worker's database pool, sized by SQLALCHEMY_POOL_SIZE and SQLALCHEMY_MAX_OVERFLOW
+
+# Seconds a stopping worker waits for its clients to leave before they are cut off
+graceful_timeout = int(os.getenv('SIM_GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.getenv('SIM_WORKER_TIMEOUT', '60'))
+keepalive = 5
+backlog = int(os.getenv('SIM_BACKLOG', '4096'))
+
+# Several workers share one port with no sticky load balancing, so a client's
+# long-polling requests could land on different workers. In that case clients
+# have to use WebSocket only and rooms are shared through the Redis message queue.
+if workers > 1:
+    raw_env = ['SOCKETIO_TRANSPORTS=websocket', 'SIM_SCALE_OUT=true']
+
+
+def post_fork(server, worker):
+    # Make psycopg2 yield to other greenlets while it waits on Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_worker_init(worker):
+    import gevent
+    from sim_service import drain_connections
+
+    # Once the worker is asked to stop, hand its clients off before the graceful timeout runs out
+    def drain_on_shutdown():
+        while worker.alive:
+            gevent.sleep(0.5)
+        drain_connections()
+
+    gevent.spawn(drain_on_shutdown)
+
+
+def worker_exit(server, worker):
+    from sim_service import chat_buffer
+
+    # Write the chat messages still buffered in this worker before it goes away
+    chat_buffer.close()
@@ -0,0 +1,69 @@
+import threading
+
+from sortedcontainers import SortedList
+
+
+class MemoryServantQueue:
+    # Waiting servants in a SortedList of (skill, servant_id)
+
+    def __init__(self):
+        self._queue = SortedList()  # (skill, servant_id)
+        self._skills = {}
+        self._lock = threading.Lock()
+
+    def add(self, servant_id, skill):
+        with self._lock:
+            self._remove(servant_id)
+            self._skills[servant_id] = skill
+            self._queue.add((skill, servant_id))
+
+    def _remove(self, servant_id):
+        skill = self._skills.pop(servant_id, None)
+        if skill is not None:
+            self._queue.remove((skill, servant_id))
+
+    def remove(self, servant_id):
+        with self._lock:
+            self._remove(servant_id)
+
+    def pop_best(self):
+        # (servant_id, skill) of the most skilled waiting servant, None when nobody waits
+        with self._lock:
+            if not self._queue:
+                return None
+            skill, servant_id = self._queue.pop()
+            del self._skills[servant_id]
+            return servant_id, skill
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class RedisServantQueue:
+    # One sorted set scored by skill. ZPOPMAX hands each servant to exactly one caller, in O(log n).
+
+    def __init__(self, redis_client, key='servants:available'):
+        self.redis = redis_client
+        self.key = key
+
+    def add(self, servant_id, skill):
+        self.redis.zadd(self.key, {servant_id: skill})
+
+    def remove(self, servant_id):
+        self.redis.zrem(self.key, servant_id)
+
+    def pop_best(self):
+        popped = self.redis.zpopmax(self.key)
+        if not popped:
+            return None
+        servant_id, skill = popped[0]
+        return int(servant_id), int(skill)
+
+    def __len__(self):
+        return self.redis.zcard(self.key)
+
+
+def servant_queue(redis_client, key='servants:available'):
+    if redis_client is None:
+        return MemoryServantQueue()
+    return RedisServantQueue(redis_client, key)
@@ -0,0 +1,121 @@
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+# Table recording applied versions, named per service so both can share a test database
+SCHEMA_VERSION_TABLE = 'sim_schema_version'
+
+# Key of the Postgres advisory lock held while migrating, so only one process migrates at a time
+MIGRATION_LOCK_ID = 5000
+
+# Versioned schema migrations, applied in order. Never edit a released one, add a new version instead.
+MIGRATIONS = [
+    (1, "Create characters, tasks, sessions, requests and session log tables", """
+        CREATE TABLE IF NOT EXISTS princess_details (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            mood_level INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS servant_details (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            skill_level INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            id SERIAL PRIMARY KEY,
+            start_timestamp TIMESTAMP WITHOUT TIME ZONE,
+            end_timestamp TIMESTAMP WITHOUT TIME ZONE,
+            princess_id INTEGER NOT NULL REFERENCES princess_details (id),
+            servant_id INTEGER NOT NULL REFERENCES servant_details (id),
+            host_port INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMP WITHOUT TIME ZONE,
+            task_id INTEGER NOT NULL REFERENCES tasks (id),
+            success BOOLEAN,
+            session_id INTEGER NOT NULL REFERENCES sessions (id),
+            princess_id INTEGER NOT NULL REFERENCES princess_details (id),
+            servant_id INTEGER NOT NULL REFERENCES servant_details (id)
+        );
+        CREATE TABLE IF NOT EXISTS session_log (
+            id SERIAL PRIMARY KEY,
+            session_id INTEGER NOT NULL REFERENCES sessions (id),
+            request_id INTEGER NOT NULL REFERENCES requests (id)
+        );
+    """),
+    (2, "Index every sim_service lookup and make characters unique per user", """
+        ALTER TABLE princess_details ADD CONSTRAINT uq_princess_details_user_id UNIQUE (user_id);
+        ALTER TABLE servant_details ADD CONSTRAINT uq_servant_details_user_id UNIQUE (user_id);
+        CREATE INDEX ix_sessions_servant_active ON sessions (servant_id) WHERE end_timestamp IS NULL;
+        CREATE INDEX ix_sessions_princess_active ON sessions (princess_id) WHERE end_timestamp IS NULL;
+        CREATE INDEX ix_requests_session_id ON requests (session_id);
+        CREATE INDEX ix_session_log_session_id ON session_log (session_id, id);
+    """),
+    (3, "Create the chat message transcript table", """
+        CREATE TABLE chat_messages (
+            id BIGSERIAL PRIMARY KEY,
+            session_id INTEGER NOT NULL REFERENCES sessions (id),
+            user_id INTEGER NOT NULL,
+            role VARCHAR(16) NOT NULL,
+            message TEXT NOT NULL,
+            sent_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        );
+        CREATE INDEX ix_chat_messages_session_id ON chat_messages (session_id, id);
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    # One query on the hot startup path, 0 when the database was never migrated
+    try:
+        return connection.execute(text(f"SELECT max(version) FROM {SCHEMA_VERSION_TABLE}")).scalar() or 0
+    except ProgrammingError:
+        connection.rollback()
+        return 0
+
+
+def migrate(engine):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        try:
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+                    version INTEGER PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+                )
+            """))
+            connection.commit()
+
+            # Another process may have migrated while we waited for the lock
+            version = current_version(connection)
+            for number, description, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                connection.execute(text(statements))
+                connection.execute(text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) VALUES (:version, :description)"),
+                                   {"version": number, "description": description})
+                connection.commit()
+        finally:
+            connection.rollback()
+            connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            connection.commit()
+
+
+def ensure_schema(engine, auto_migrate):
+    with engine.connect() as connection:
+        version = current_version(connection)
+
+    if version == LATEST_VERSION:
+        return
+    if version > LATEST_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this code ({LATEST_VERSION})")
+    if not auto_migrate:
+        raise RuntimeError(f"Database schema is at version {version}, expected {LATEST_VERSION}. Run 'flask --app sim_service migrate'.")
+    migrate(engine)
@@ -0,0 +1,128 @@
+import math
+import threading
+import time
+from contextlib import ExitStack
+
+import redis
+
+# KEYS: one hash of tokens and last update time per bucket. ARGV: now, cost, then rate, burst
+# and ttl of every bucket. Takes cost tokens from every bucket or from none, and returns the
+# seconds to wait per bucket (as strings, Lua numbers would be truncated to integers).
+TAKE_ALL_SCRIPT = """
+local now, cost = tonumber(ARGV[1]), tonumber(ARGV[2])
+local levels, waits, blocked = {}, {}, false
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local level = burst
+    if state[1] then
+        level = math.min(burst, tonumber(state[1]) + math.max(now - tonumber(state[2]), 0) * rate)
+    end
+    levels[i] = level
+    if level < cost then
+        waits[i] = tostring((cost - level) / rate)
+        blocked = true
+    else
+        waits[i] = '0'
+    end
+end
+if not blocked then
+    for i, key in ipairs(KEYS) do
+        redis.call('HSET', key, 'tokens', tostring(levels[i] - cost), 'updated', ARGV[1])
+        redis.call('EXPIRE', key, ARGV[3 * i + 2])
+    end
+end
+return waits
+"""
+
+
+def refill(tokens, elapsed, rate, burst):
+    # Tokens in a bucket after elapsed seconds, a bucket seen for the first time is full
+    if tokens is None:
+        return burst
+    return min(burst, tokens + max(elapsed, 0) * rate)
+
+
+def take_all(takes, cost=1):
+    # takes: (bucket, key) pairs, all of the same kind. Takes cost tokens from every bucket or,
+    # when any of them is short, from none. Returns the seconds to wait per bucket, all 0 when taken.
+    if isinstance(takes[0][0], RedisTokenBucket):
+        return RedisTokenBucket.take_all(takes, cost)
+    return MemoryTokenBucket.take_all(takes, cost)
+
+
+class MemoryTokenBucket:
+    # Each key gets rate tokens per second up to burst, and every event takes one
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def _sweep(self, now):
+        # Drop buckets that have refilled completely, they behave like new ones
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if refill(tokens, now - updated, self.rate, self.burst) >= self.burst:
+                del self._buckets[key]
+
+    def _level(self, key, now):
+        self._takes += 1
+        if self._takes % 10000 == 0:
+            self._sweep(now)
+        tokens, updated = self._buckets.get(key, (None, now))
+        return refill(tokens, now - updated, self.rate, self.burst)
+
+    @staticmethod
+    def take_all(takes, cost=1):
+        now = time.time()
+        with ExitStack() as stack:
+            for lock in {id(bucket._lock): bucket._lock for bucket, _ in takes}.values():
+                stack.enter_context(lock)
+            levels = [bucket._level(key, now) for bucket, key in takes]
+            waits = [0 if level >= cost else (cost - level) / bucket.rate
+                     for (bucket, _), level in zip(takes, levels)]
+            if not any(waits):
+                for (bucket, key), level in zip(takes, levels):
+                    bucket._buckets[key] = (level - cost, now)
+            return waits
+
+    def take(self, key, cost=1):
+        # Take cost tokens, returns 0 when allowed, otherwise the seconds until enough are back
+        return self.take_all([(self, key)], cost)[0]
+
+
+class RedisTokenBucket:
+    # One hash of tokens and last update time per key. Every take is one EVAL of TAKE_ALL_SCRIPT,
+    # so concurrent takes never share a token and never retry. Falls back to a MemoryTokenBucket
+    # while Redis is down.
+
+    def __init__(self, redis_client, prefix, rate, burst):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+        self.ttl = math.ceil(burst / rate) + 1  # An idle bucket is full again by then
+        self.fallback = MemoryTokenBucket(rate, burst)
+        self.script = redis_client.register_script(TAKE_ALL_SCRIPT)
+
+    @staticmethod
+    def take_all(takes, cost=1):
+        args = [time.time(), cost]
+        for bucket, _ in takes:
+            args += [bucket.rate, bucket.burst, bucket.ttl]
+        try:
+            waits = takes[0][0].script(keys=[f'{bucket.prefix}:{key}' for bucket, key in takes], args=args)
+        except redis.RedisError:
+            return MemoryTokenBucket.take_all([(bucket.fallback, key) for bucket, key in takes], cost)
+        return [float(wait) for wait in waits]
+
+    def take(self, key, cost=1):
+        return self.take_all([(self, key)], cost)[0]
+
+
+def token_bucket(redis_client, prefix, rate, burst):
+    if redis_client is None:
+        return MemoryTokenBucket(rate, burst)
+    return RedisTokenBucket(redis_client, prefix, rate, burst)
@@ -0,0 +1,103 @@
+import json
+import threading
+from collections import deque
+
+import redis
+
+
+class MemoryRoomStream:
+    # A capped deque of (seq, event, payload) per room, numbered by a counter per room
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._rooms = {}
+        self._sequences = {}
+        self._lock = threading.Lock()
+
+    def append_many(self, items):
+        # items: (room_id, event, payload) tuples, returns their sequence numbers
+        sequences = []
+        with self._lock:
+            for room_id, event, payload in items:
+                room_id = str(room_id)
+                seq = self._sequences.get(room_id, 0) + 1
+                self._sequences[room_id] = seq
+                self._rooms.setdefault(room_id, deque(maxlen=self.maxlen)).append((seq, event, payload))
+                sequences.append(seq)
+        return sequences
+
+    def append(self, room_id, event, payload):
+        return self.append_many([(room_id, event, payload)])[0]
+
+    def since(self, room_id, after, limit):
+        # Events with a sequence number above after, and whether none were trimmed in between
+        with self._lock:
+            entries = list(self._rooms.get(str(room_id), ()))
+        # An empty room is only complete for a client that has not seen anything yet, one that
+        # has outlived its history (expired, or lost with the node) may have missed events
+        complete = entries[0][0] <= after + 1 if entries else after <= 0
+        return [entry for entry in entries if entry[0] > after][:limit], complete
+
+    def drop(self, room_id):
+        # Forget a closed room, its events and its counter
+        with self._lock:
+            self._rooms.pop(str(room_id), None)
+            self._sequences.pop(str(room_id), None)
+
+
+class RedisRoomStream:
+    # One capped Redis stream per room. Entry ids are 0-<seq>, with the sequence part
+    # auto-incremented by XADD (Redis 7), so sequence numbers are per-room integers with no
+    # separate counter.
+
+    def __init__(self, redis_client, prefix='room', suffix='events', maxlen=1000, ttl=86400):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.suffix = suffix
+        self.maxlen = maxlen
+        self.ttl = ttl
+
+    def _key(self, room_id):
+        return f'{self.prefix}:{room_id}:{self.suffix}'
+
+    def append_many(self, items):
+        # items: (room_id, event, payload) tuples, returns their sequence numbers (None while Redis is down)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for room_id, event, payload in items:
+                pipeline.xadd(self._key(room_id), {"event": event, "data": json.dumps(payload)},
+                              id='0-*', maxlen=self.maxlen, approximate=True)
+                pipeline.expire(self._key(room_id), self.ttl)
+            results = pipeline.execute()
+        except redis.RedisError:
+            return [None] * len(items)
+        return [int(entry_id.split(b'-')[1]) for entry_id in results[::2]]
+
+    def append(self, room_id, event, payload):
+        return self.append_many([(room_id, event, payload)])[0]
+
+    def since(self, room_id, after, limit):
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.xrange(self._key(room_id), '-', '+', count=1)
+            pipeline.xrange(self._key(room_id), f'(0-{after}', '+', count=limit)
+            first, entries = pipeline.execute()
+        except redis.RedisError:
+            return [], False
+
+        complete = int(first[0][0].split(b'-')[1]) <= after + 1 if first else after <= 0
+        return [(int(entry_id.split(b'-')[1]), fields[b'event'].decode(), json.loads(fields[b'data']))
+                for entry_id, fields in entries], complete
+
+    def drop(self, room_id):
+        # Delete a closed room's stream rather than wait for it to expire
+        try:
+            self.redis.delete(self._key(room_id))
+        except redis.RedisError:
+            pass  # It still expires after ttl
+
+
+def room_stream(redis_client, suffix='events', maxlen=1000):
+    if redis_client is None:
+        return MemoryRoomStream(maxlen)
+    return RedisRoomStream(redis_client, suffix=suffix, maxlen=maxlen)
@@ -0,0 +1,246 @@
+import json
+import logging
+import time
+import uuid
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Fields of a session:{id} hash, all stored as integers ('' for None)
+SESSION_FIELDS = ('princess_id', 'servant_id', 'host_port', 'princess_mood', 'servant_skill', 'open_requests', 'ended')
+
+
+def decode_int(value):
+    if value is None or value == b'':
+        return None
+    return int(value)
+
+
+class SessionStore:
+    # Live session state kept in Redis so hot reads skip Postgres:
+    #   session:{id}              hash of SESSION_FIELDS
+    #   servant:{id}:session      id of the servant's active session
+    #   character:{user_id}       hash of the user's princess_id and servant_id (0 when the user has none)
+    # Misses return None and callers load from Postgres, then cache the result.
+    # Session ends are appended to a journal list in the same transaction, and a
+    # JournalFlusher writes them behind to Postgres. Levels are written by the tick engine.
+
+    def __init__(self, redis_client, ttl=86400, ended_ttl=3600, journal_key='sessions:journal'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.ended_ttl = ended_ttl
+        self.journal_key = journal_key
+
+    @property
+    def enabled(self):
+        return self.redis is not None
+
+    def _session_key(self, session_id):
+        return f'session:{session_id}'
+
+    def _servant_key(self, servant_id):
+        return f'servant:{servant_id}:session'
+
+    def _character_key(self, user_id):
+        return f'character:{user_id}'
+
+    def session(self, session_id):
+        if not self.enabled:
+            return None
+        try:
+            values = self.redis.hgetall(self._session_key(session_id))
+        except redis.RedisError:
+            return None
+        # A hash holding only engine-written levels is not a cached session yet
+        if not values or b'princess_id' not in values:
+            return None
+        state = dict((field, decode_int(values.get(field.encode()))) for field in SESSION_FIELDS)
+        state['ended'] = bool(state['ended'])
+        return state
+
+    def cache_session(self, session_id, state):
+        # HSETNX so a concurrent change recorded in the meantime is not overwritten by older data
+        if not self.enabled:
+            return
+        key = self._session_key(session_id)
+        try:
+            pipeline = self.redis.pipeline()
+            for field in SESSION_FIELDS:
+                value = state.get(field)
+                pipeline.hsetnx(key, field, '' if value is None else int(value))
+            pipeline.expire(key, self.ended_ttl if state.get('ended') else self.ttl)
+            if not state.get('ended'):
+                pipeline.set(self._servant_key(state['servant_id']), session_id, ex=self.ttl)
+            pipeline.execute()
+        except redis.RedisError:
+            pass
+
+    def servant_session(self, servant_id):
+        if not self.enabled:
+            return None
+        try:
+            return decode_int(self.redis.get(self._servant_key(servant_id)))
+        except redis.RedisError:
+            return None
+
+    def character(self, user_id):
+        if not self.enabled:
+            return None
+        try:
+            values = self.redis.hgetall(self._character_key(user_id))
+        except redis.RedisError:
+            return None
+        if not values:
+            return None
+        return {
+            "princess_id": decode_int(values.get(b'princess_id')) or None,
+            "servant_id": decode_int(values.get(b'servant_id')) or None
+        }
+
+    def cache_character(self, user_id, princess_id, servant_id):
+        if not self.enabled:
+            return
+        key = self._character_key(user_id)
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.hset(key, mapping={"princess_id": princess_id or 0, "servant_id": servant_id or 0})
+            pipeline.expire(key, self.ttl)
+            pipeline.execute()
+        except redis.RedisError:
+            pass
+
+    def forget_character(self, user_id):
+        # Call after adding a character for this user
+        if not self.enabled:
+            return
+        try:
+            self.redis.delete(self._character_key(user_id))
+        except redis.RedisError:
+            pass
+
+    def _change(self, session_id, fields=None, increments=None, entry=None, ttl=None):
+        # Apply changes to the hash only while it exists, so an increment never leaves a
+        # partial hash behind, and journal the entry in the same transaction.
+        # Returns False when Redis is unavailable and the caller has to write Postgres itself.
+        if not self.enabled:
+            return False
+        key = self._session_key(session_id)
+
+        def apply(pipeline):
+            exists = pipeline.exists(key)
+            pipeline.multi()
+            if exists:
+                if fields:
+                    pipeline.hset(key, mapping=fields)
+                for field, amount in (increments or {}).items():
+                    pipeline.hincrby(key, field, amount)
+                pipeline.expire(key, ttl or self.ttl)
+            if entry is not None:
+                pipeline.rpush(self.journal_key, json.dumps(entry))
+
+        try:
+            self.redis.transaction(apply, key)
+        except redis.RedisError:
+            return False
+        return True
+
+    def add_open_requests(self, session_id, count):
+        # Request rows are written to Postgres directly, this only keeps the live counter
+        return self._change(session_id, increments={"open_requests": count})
+
+    def cache_levels(self, mood_changes, skill_changes):
+        # Levels computed by the tick engine, which writes Postgres itself, so nothing is journaled.
+        # Each argument is a list of (session_id, value).
+        if not self.enabled:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for field, changes in (('princess_mood', mood_changes), ('servant_skill', skill_changes)):
+                for session_id, value in changes:
+                    pipeline.hset(self._session_key(session_id), field, value)
+                    pipeline.expire(self._session_key(session_id), self.ttl)
+            pipeline.execute()
+        except redis.RedisError:
+            pass
+
+    def end_session(self, session_id, servant_id, write_behind=True):
+        # write_behind=False when the caller has ended the session in Postgres already
+        entry = {"session_id": int(session_id), "ended_at": time.time()} if write_behind else None
+        ended = self._change(session_id, fields={"ended": 1}, ttl=self.ended_ttl, entry=entry)
+        if ended:
+            try:
+                self.redis.delete(self._servant_key(servant_id))
+            except redis.RedisError:
+                pass
+        return ended
+
+
+class LeaderLock:
+    # Lets one node at a time run a cluster-wide job, held for ttl seconds unless extended
+
+    def __init__(self, redis_client, key, ttl):
+        self.redis = redis_client
+        self.key = key
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        # Take or extend the lock, True while this node holds it
+        if self.redis.set(self.key, self.token, nx=True, ex=self.ttl):
+            return True
+        if self.redis.get(self.key) == self.token.encode():
+            self.redis.expire(self.key, self.ttl)
+            return True
+        return False
+
+
+class JournalFlusher:
+    # Writes journaled session ends behind to Postgres in batches.
+    # One node at a time holds the leader lock. Entries are moved one by one (LMOVE)
+    # to a processing list before they are applied and dropped only after apply_entries
+    # returned, so a flusher that crashes mid-batch leaves them for the next leader
+    # to replay. apply_entries must be idempotent.
+
+    def __init__(self, redis_client, apply_entries, journal_key='sessions:journal', batch_size=1000, lock_ttl=10):
+        self.redis = redis_client
+        self.apply_entries = apply_entries
+        self.journal_key = journal_key
+        self.processing_key = f'{journal_key}:processing'
+        self.batch_size = batch_size
+        self.leader = LeaderLock(redis_client, f'{journal_key}:leader', lock_ttl)
+
+    def flush(self):
+        # Apply one batch, returns the number of entries written
+        if not self.leader.acquire():
+            return 0
+
+        # Entries a crashed leader had taken but not applied come first
+        entries = self.redis.lrange(self.processing_key, 0, -1)
+        if not entries:
+            # Only the leader takes entries, so the journal holds at least what LLEN counted.
+            # An idle journal costs one command per flush instead of batch_size.
+            waiting = self.redis.llen(self.journal_key)
+            if not waiting:
+                return 0
+            pipeline = self.redis.pipeline(transaction=False)
+            for _ in range(min(waiting, self.batch_size)):
+                pipeline.lmove(self.journal_key, self.processing_key, 'LEFT', 'RIGHT')
+            entries = [entry for entry in pipeline.execute() if entry is not None]
+        if not entries:
+            return 0
+
+        self.apply_entries([json.loads(entry) for entry in entries])
+        self.redis.delete(self.processing_key)
+        return len(entries)
+
+    def run(self, sleep, interval=1.0):
+        # Background loop: drain while there is a backlog, otherwise wait for the next interval
+        while True:
+            try:
+                flushed = self.flush()
+            except Exception:
+                logger.exception('Session journal flush failed, retrying')
+                flushed = 0
+            if flushed < self.batch_size:
+                sleep(interval)
@@ -1,26 +1,75 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context, session as socket_session
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
-from flask_socketio import SocketIO, send, join_room, leave_room, disconnect
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room, leave_room, disconnect
+import click
 import redis
 import requests
 import os
+import logging
+import time
+import atexit
+import datetime
+import msgpack
+import sqlalchemy.exc
+from migrations import ensure_schema, migrate
+from catalog import TaskCatalog
+from session_state import SessionStore, JournalFlusher, LeaderLock
+from engine import TickEngine, event_queue
+from matchmaking import servant_queue as make_servant_queue
+from activity import activity_tracker
+from room_events import room_stream
+from chat_log import ChatBuffer
+from rate_limit import take_all, token_bucket
+from broadcast import BroadcastBatcher, room_members
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")  # Initialize SocketIO
+logger = logging.getLogger(__name__)
+
+# Scale-out mode: rooms are shared between workers and nodes through the Redis message queue
+SCALE_OUT = os.getenv('SIM_SCALE_OUT', 'false').lower() == 'true'
+message_queue = None
+if SCALE_OUT:
+    message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE', f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', '6379')}/0")
+
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    message_queue=message_queue,
+    async_mode=os.getenv('SOCKETIO_ASYNC_MODE'),
+    transports=os.getenv('SOCKETIO_TRANSPORTS', 'polling,websocket').split(',')
+)  # Initialize SocketIO
 
 redis_client = redis.StrictRedis(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=0)
+# Helpers share their state through Redis when a host is configured, None keeps it in process
+shared_redis = redis_client if os.getenv('REDIS_HOST') else None
 
 # Configuration for the simulation service's database
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'postgresql://test_user:test_password@db:5432/test_db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key'  # Use the same secret key as the Authentication Service
+
+# Database connections per worker process. Thousands of greenlets share them, the ones
+# beyond pool_size + max_overflow wait up to pool_timeout seconds for a free connection.
+# Keep workers * (pool_size + max_overflow) under Postgres' max_connections (100 by default).
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": int(os.getenv('SQLALCHEMY_POOL_SIZE', '20')),
+    "max_overflow": int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', '20')),
+    "pool_timeout": float(os.getenv('SQLALCHEMY_POOL_TIMEOUT', '30'))
+}
+
+# Most task requests accepted by one /simulation/request/tasks call
+REQUEST_BATCH_LIMIT = int(os.getenv('REQUEST_BATCH_LIMIT', '1000'))
+
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 
 # Princess Details Model
 class PrincessDetails(db.Model):
     __tablename__ = 'princess_details'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', name='uq_princess_details_user_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, nullable=False)
@@ -29,6 +78,9 @@ class PrincessDetails(db.Model):
 # Servant Details Model
 class ServantDetails(db.Model):
     __tablename__ = 'servant_details'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', name='uq_servant_details_user_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, nullable=False)
@@ -41,9 +93,30 @@ class Tasks(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(255), nullable=False)
 
+def load_task_catalog():
+    return db.session.execute(db.select(Tasks.id, Tasks.name)).all()
+
+def load_task_catalog_version():
+    # Checksum of the whole tasks table, a single small row however many tasks there are
+    return db.session.execute(db.text("SELECT md5(string_agg(id || ':' || name, ',' ORDER BY id)) FROM tasks")).scalar()
+
+# Task catalog cache, kept current on every node through a version key in Redis, or without
+# Redis through a checksum of the tasks table
+task_catalog = TaskCatalog(
+    load_task_catalog,
+    redis_client=shared_redis,
+    load_version=load_task_catalog_version,
+    check_interval=float(os.getenv('TASK_CATALOG_CHECK_INTERVAL', '1'))
+)
+
 # Session Model
 class Session(db.Model):
     __tablename__ = 'sessions'
+    __table_args__ = (
+        # Active sessions are looked up by participant, ended ones stay out of these indexes
+        db.Index('ix_sessions_servant_active', 'servant_id', postgresql_where=db.text('end_timestamp IS NULL')),
+        db.Index('ix_sessions_princess_active', 'princess_id', postgresql_where=db.text('end_timestamp IS NULL')),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     
@@ -66,7 +139,7 @@ class Request(db.Model):
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id'), nullable=False)
     
     success = db.Column(db.Boolean, nullable=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False, index=True)
     princess_id = db.Column(db.Integer, db.ForeignKey('princess_details.id'),nullable=False)
     servant_id = db.Column(db.Integer, db.ForeignKey('servant_details.id'),nullable=False) 
 
@@ -74,15 +147,541 @@ class Request(db.Model):
 # Session Log Model
 class SessionLog(db.Model):
     __tablename__ = 'session_log'
+    __table_args__ = (
+        db.Index('ix_session_log_session_id', 'session_id', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
     request_id = db.Column(db.Integer, db.ForeignKey('requests.id'), nullable=False)
 
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+# Chat Message Model, written in batches by the chat buffer
+class ChatMessage(db.Model):
+    __tablename__ = 'chat_messages'
+    __table_args__ = (
+        db.Index('ix_chat_messages_session_id', 'session_id', 'id'),
+    )
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    role = db.Column(db.String(16), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=False)
+
+
+# Live session state in Redis, written behind to Postgres by the journal flusher
+session_store = SessionStore(
+    shared_redis,
+    ttl=int(os.getenv('SESSION_STATE_TTL', '86400'))
+)
+session_flusher = None
+
+
+def write_chat_messages(rows):
+    # One multi-row INSERT per batch (executemany with insertmanyvalues)
+    with app.app_context():
+        db.session.execute(db.insert(ChatMessage), rows)
+        db.session.commit()
+
+# Chat transcript buffer, bounded so a slow database pushes back on senders instead of growing memory
+chat_buffer = ChatBuffer(
+    write_chat_messages,
+    max_size=int(os.getenv('CHAT_BUFFER_SIZE', '10000')),
+    batch_size=int(os.getenv('CHAT_FLUSH_BATCH_SIZE', '500')),
+    flush_interval=float(os.getenv('CHAT_FLUSH_INTERVAL', '1')),
+    put_timeout=float(os.getenv('CHAT_BUFFER_PUT_TIMEOUT', '1')),
+    transient=lambda error: isinstance(error, sqlalchemy.exc.OperationalError)
+)
+chat_flusher_started = False
+
+# Longest chat message accepted, in characters
+CHAT_MESSAGE_MAX_LENGTH = int(os.getenv('CHAT_MESSAGE_MAX_LENGTH', '2000'))
+
+
+def load_session_state(session_id):
+    # Served from Redis, loaded from Postgres and cached on a miss
+    state = session_store.session(session_id)
+    if state is not None:
+        return state
+
+    open_requests = db.select(db.func.count(Request.id)) \
+        .where(Request.session_id == Session.id, Request.success.is_(None)).scalar_subquery()
+    row = db.session.execute(
+        db.select(Session.princess_id, Session.servant_id, Session.host_port, Session.end_timestamp,
+                  PrincessDetails.mood_level, ServantDetails.skill_level, open_requests)
+        .join(PrincessDetails, PrincessDetails.id == Session.princess_id)
+        .join(ServantDetails, ServantDetails.id == Session.servant_id)
+        .where(Session.id == session_id)
+    ).first()
+    if not row:
+        return None
+
+    state = {
+        "princess_id": row[0],
+        "servant_id": row[1],
+        "host_port": row[2],
+        "ended": row[3] is not None,
+        "princess_mood": row[4],
+        "servant_skill": row[5],
+        "open_requests": row[6]
+    }
+    session_store.cache_session(session_id, state)
+    return state
+
+
+def load_character(user_id):
+    # The user's princess and servant ids (None when missing), cached in Redis
+    character = session_store.character(user_id)
+    if character is not None:
+        return character
+
+    princess_id, servant_id = db.session.execute(db.select(
+        db.select(PrincessDetails.id).where(PrincessDetails.user_id == user_id).scalar_subquery(),
+        db.select(ServantDetails.id).where(ServantDetails.user_id == user_id).scalar_subquery()
+    )).one()
+    session_store.cache_character(user_id, princess_id, servant_id)
+    return {"princess_id": princess_id, "servant_id": servant_id}
+
+
+def write_levels(princess_ids, moods, servant_ids, skills):
+    # Bulk UPDATE ... FROM unnest, one statement per table whatever the number of rows
+    if princess_ids:
+        db.session.execute(db.text("""
+            UPDATE princess_details SET mood_level = changes.mood_level
+            FROM unnest(:ids, :values) AS changes (id, mood_level)
+            WHERE princess_details.id = changes.id
+        """), {"ids": princess_ids, "values": moods})
+    if servant_ids:
+        db.session.execute(db.text("""
+            UPDATE servant_details SET skill_level = changes.skill_level
+            FROM unnest(:ids, :values) AS changes (id, skill_level)
+            WHERE servant_details.id = changes.id
+        """), {"ids": servant_ids, "values": skills})
+
+
+def persist_session_ends(entries):
+    # Write-behind of journaled session ends. Only sessions still open are ended,
+    # so replaying a batch twice is harmless.
+    ends = {}
+    for entry in entries:
+        if 'ended_at' in entry:
+            ends.setdefault(entry['session_id'], entry['ended_at'])
+
+    with app.app_context():
+        if ends:
+            db.session.execute(db.text("""
+                UPDATE sessions SET end_timestamp = to_timestamp(changes.ended_at)::timestamp
+                FROM unnest(:ids, :values) AS changes (id, ended_at)
+                WHERE sessions.id = changes.id AND sessions.end_timestamp IS NULL
+            """), {"ids": list(ends), "values": list(ends.values())})
+        db.session.commit()
+
+
+# Simulation engine advancing mood and skill of every active session, opt-in with SIM_ENGINE=true
+SIM_ENGINE = os.getenv('SIM_ENGINE', 'false').lower() == 'true'
+SIM_TICK_INTERVAL = float(os.getenv('SIM_TICK_INTERVAL', '1'))
+SIM_EVENT_BATCH_SIZE = 10000
+# Rooms hear about their princess's mood when it crosses a multiple of this many points,
+# not on every tick it moves
+MOOD_NOTIFY_STEP = int(os.getenv('MOOD_NOTIFY_STEP', '10'))
+sim_events = event_queue(shared_redis) if SIM_ENGINE else None
+engine_started = False
+
+
+def push_events(*events):
+    # Pushed after the change is committed, stamped so a newly loaded engine knows which
+    # events its snapshot already reflects
+    if sim_events is not None:
+        at = time.time()
+        sim_events.push(*[dict(event, at=at) for event in events])
+
+
+def load_tick_engine():
+    # Every active session with its levels and pending request count, in one query.
+    # Returns the engine and the time the snapshot was taken.
+    snapshot_at = time.time()
+    open_requests = db.select(db.func.count(Request.id)) \
+        .where(Request.session_id == Session.id, Request.success.is_(None)).scalar_subquery()
+    rows = db.session.execute(
+        db.select(Session.id, Session.princess_id, Session.servant_id,
+                  PrincessDetails.mood_level, ServantDetails.skill_level, open_requests)
+        .join(PrincessDetails, PrincessDetails.id == Session.princess_id)
+        .join(ServantDetails, ServantDetails.id == Session.servant_id)
+        .where(Session.end_timestamp.is_(None))
+    ).all()
+
+    engine = TickEngine(capacity=max(1024, len(rows)), mood_notify_step=MOOD_NOTIFY_STEP)
+    if rows:
+        engine.add_sessions(*[list(column) for column in zip(*rows)])
+    return engine, snapshot_at
+
+
+def flush_levels(changes):
+    mood_sessions, princess_ids, moods = changes['moods']
+    skill_sessions, servant_ids, skills = changes['skills']
+    notice_sessions, notice_moods = changes['mood_notices']
+    if not len(princess_ids) and not len(servant_ids):
+        return
+
+    with app.app_context():
+        write_levels(princess_ids.tolist(), moods.tolist(), servant_ids.tolist(), skills.tolist())
+        db.session.commit()
+    session_store.cache_levels(zip(mood_sessions.tolist(), moods.tolist()), zip(skill_sessions.tolist(), skills.tolist()))
+    publish_room_events([(session_id, 'mood_changed', {"mood": mood})
+                         for session_id, mood in zip(notice_sessions.tolist(), notice_moods.tolist())])
+
+
+def run_tick_engine():
+    # One leader across the nodes advances the simulation, the others stand by
+    leader = LeaderLock(shared_redis, 'sim:engine:leader', max(10, int(SIM_TICK_INTERVAL * 5))) if shared_redis else None
+    engine = snapshot_at = None
+    while True:
+        started_at = time.monotonic()
+        try:
+            if leader is not None and not leader.acquire():
+                engine = None
+            else:
+                if engine is None:
+                    # Events still queued, e.g. by the previous leader, are replayed on top of the
+                    # snapshot. Their completions count, their pending changes are in it already.
+                    with app.app_context():
+                        engine, snapshot_at = load_tick_engine()
+                for _ in range(100):
+                    events = sim_events.pop(SIM_EVENT_BATCH_SIZE)
+                    engine.apply_events(events, snapshot_at)
+                    if len(events) < SIM_EVENT_BATCH_SIZE:
+                        break
+                flush_levels(engine.tick())
+        except Exception:
+            logger.exception('Simulation tick failed, reloading the engine')
+            engine = None
+        socketio.sleep(max(0, SIM_TICK_INTERVAL - (time.monotonic() - started_at)))
+
+
+# Idle-session reaper closing sessions without requests or messages for SESSION_IDLE_TIMEOUT
+# seconds, opt-in with SIM_REAPER=true
+SIM_REAPER = os.getenv('SIM_REAPER', 'false').lower() == 'true'
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', '1800'))
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '30'))
+REAPER_BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', '1000'))
+session_activity = activity_tracker(shared_redis)
+reaper_started = False
+
+
+def seed_session_activity():
+    # Active sessions not tracked yet count as active since their start or last request
+    rows = db.session.execute(db.text("""
+        SELECT sessions.id, extract(epoch FROM greatest(sessions.start_timestamp, max(requests.timestamp)))
+        FROM sessions LEFT JOIN requests ON requests.session_id = sessions.id
+        WHERE sessions.end_timestamp IS NULL
+        GROUP BY sessions.id
+    """)).all()
+    session_activity.touch_missing([(session_id, float(at) if at else time.time()) for session_id, at in rows])
+
+
+def close_session_rooms(session_id, reason):
+    # Tell the rooms, disconnect this node's clients and drop the rooms on every node.
+    # Clients on other nodes are left out of the rooms and disconnect when they get room_closed,
+    # and handle_message refuses them once the end is in the shared session state.
+    # Ended sessions cannot be rejoined, so their event and chat history go too.
+    rooms = room_variants(session_id)
+    socketio.emit('room_closed', {"room_id": rooms[0], "reason": reason}, to=rooms)
+    for room in rooms:
+        for sid, _ in list(socketio.server.manager.get_participants('/', room)):
+            socketio.server.disconnect(sid, ignore_queue=True)
+        socketio.close_room(room)
+    room_events.drop(session_id)
+    chat_history.drop(session_id)
+
+
+def reap_idle_sessions():
+    # Close one batch of idle sessions with a single UPDATE, returns the size of the batch
+    idle = session_activity.idle(time.time() - SESSION_IDLE_TIMEOUT, REAPER_BATCH_SIZE)
+    if not idle:
+        return 0
+
+    with app.app_context():
+        closed = db.session.execute(db.text("""
+            UPDATE sessions SET end_timestamp = now()
+            WHERE id = ANY(:ids) AND end_timestamp IS NULL
+            RETURNING id, servant_id
+        """), {"ids": idle}).all()
+        db.session.commit()
+    session_activity.forget(idle)
+
+    for session_id, servant_id in closed:
+        session_store.end_session(session_id, servant_id, write_behind=False)
+        close_session_rooms(session_id, 'idle')
+    if closed:
+        push_events(*[{"type": "session_ended", "session_id": session_id} for session_id, _ in closed])
+    return len(idle)
+
+
+def run_reaper():
+    # One leader across the nodes reaps, the others stand by
+    leader = LeaderLock(shared_redis, 'sessions:reaper:leader', max(10, int(REAPER_INTERVAL * 3))) if shared_redis else None
+    seeded = False
+    while True:
+        try:
+            if leader is not None and not leader.acquire():
+                seeded = False
+            else:
+                if not seeded:
+                    with app.app_context():
+                        seed_session_activity()
+                    seeded = True
+                while reap_idle_sessions() == REAPER_BATCH_SIZE:
+                    pass
+        except Exception:
+            logger.exception('Reaping idle sessions failed, retrying')
+        socketio.sleep(REAPER_INTERVAL)
+
+
+# Clients that negotiated batching at connect (?batch=1) sit in the room's batch sub-room and get
+# the room's broadcasts gathered over BROADCAST_BATCH_WINDOW_MS as one batch event. 0 turns it off.
+BROADCAST_BATCH_WINDOW = float(os.getenv('BROADCAST_BATCH_WINDOW_MS', '5')) / 1000
+
+# Clients that negotiated MessagePack at connect (?encoding=msgpack) sit in msgpack sub-rooms and get
+# room broadcasts as one binary packed event, {"event", "args"} encoded with MessagePack.
+# Everyone else, and everyone when SOCKET_MSGPACK is off, gets JSON.
+SOCKET_MSGPACK = os.getenv('SOCKET_MSGPACK', 'true').lower() == 'true'
+
+
+def packed(event, args):
+    return msgpack.packb({"event": event, "args": list(args)})
+
+
+# Members of the batch and msgpack sub-rooms, so rooms where nobody opted in cost one emit per broadcast.
+# With Redis each node keeps its rooms' counters alive, a counter nobody refreshes expires after
+# ROOM_MEMBERS_TTL seconds.
+sub_room_members = room_members(shared_redis, key_ttl=int(os.getenv('ROOM_MEMBERS_TTL', '60')))
+members_refresher_started = False
+
+
+def emit_batch(room, events):
+    active = sub_room_members.active([room, msgpack_room(room)])
+    if room in active:
+        socketio.emit('batch', {"events": events}, to=room)
+    if msgpack_room(room) in active:
+        socketio.emit('packed', packed('batch', [{"events": events}]), to=msgpack_room(room))
+
+
+broadcast_batcher = BroadcastBatcher(emit_batch, window=BROADCAST_BATCH_WINDOW,
+                                     max_events=int(os.getenv('BROADCAST_BATCH_MAX_EVENTS', '100')))
+batcher_started = False
+
+
+def batch_room(room_id):
+    return f'{room_id}:batch'
+
+
+def msgpack_room(room):
+    return f'{room}:msgpack'
+
+
+def room_variants(room_id):
+    # Every Socket.IO room a member of this session's room can be in
+    rooms = [str(room_id), batch_room(room_id)]
+    return rooms + [msgpack_room(room) for room in rooms]
+
+
+def client_room(context):
+    # The room this connection joins to receive its session's broadcasts
+    room = batch_room(context['room_id']) if context['batch'] else context['room_id']
+    return msgpack_room(room) if context['encoding'] == 'msgpack' else room
+
+
+def broadcast_many(items):
+    # items: (room_id, event, args) tuples. Every room broadcast goes through here: sent now to
+    # plain clients, batched for the others. Sub-rooms only get an emit while someone is in them,
+    # which is looked up once for all the items.
+    for room_id, event, args in items:
+        socketio.emit(event, args[0] if len(args) == 1 else args, to=str(room_id))
+    if not (SOCKET_MSGPACK or BROADCAST_BATCH_WINDOW) or not items:
+        return
+    active = sub_room_members.active([room for room_id, _, _ in items for room in room_variants(room_id)[1:]])
+    if not active:
+        return
+    for room_id, event, args in items:
+        if msgpack_room(room_id) in active:
+            socketio.emit('packed', packed(event, args), to=msgpack_room(room_id))
+        if batch_room(room_id) in active or msgpack_room(batch_room(room_id)) in active:
+            broadcast_batcher.add(batch_room(room_id), event, args)
+
+
+def broadcast(room_id, event, *args):
+    broadcast_many([(room_id, event, args)])
+
+
+def send_to_client(context, event, *args):
+    # Like broadcast, for the current connection only, in the encoding it negotiated
+    if context['encoding'] == 'msgpack':
+        emit('packed', packed(event, args))
+    else:
+        emit(event, args[0] if len(args) == 1 else args)
+
+
+# Typed room events with per-room sequence numbers, kept so reconnecting clients can sync
+room_events = room_stream(shared_redis,
+                          maxlen=int(os.getenv('ROOM_EVENTS_MAXLEN', '1000')))
+ROOM_SYNC_LIMIT = 1000
+
+
+def publish_room_events(items):
+    # items: (session_id, event, payload) tuples. Each event is numbered, kept and emitted to its room.
+    sequences = room_events.append_many(items)
+    broadcast_many([(session_id, event, (dict(payload, session_id=session_id, seq=seq),))
+                    for (session_id, event, payload), seq in zip(items, sequences)])
+
+
+# Chat history per room, capped at CHAT_HISTORY_MAXLEN messages so each room's memory stays bounded
+chat_history = room_stream(shared_redis, suffix='messages',
+                           maxlen=int(os.getenv('CHAT_HISTORY_MAXLEN', '500')))
+CHAT_RESUME_LIMIT = 500
+
+# Chat rate limits: tokens per second and burst size, per connection (sid) and per room
+connection_message_limit = token_bucket(shared_redis, 'ratelimit:sid',
+                                        rate=float(os.getenv('SOCKET_MESSAGE_RATE', '5')),
+                                        burst=float(os.getenv('SOCKET_MESSAGE_BURST', '10')))
+room_message_limit = token_bucket(shared_redis, 'ratelimit:room',
+                                  rate=float(os.getenv('ROOM_MESSAGE_RATE', '20')),
+                                  burst=float(os.getenv('ROOM_MESSAGE_BURST', '40')))
+
+
+def message_throttle(room_id, event='send_message'):
+    # None when this connection may send to its room now, otherwise the throttled event to send back.
+    # Every event that broadcasts to the room takes a token from both buckets, or from neither
+    # when one of them is empty.
+    waits = take_all([(connection_message_limit, request.sid), (room_message_limit, room_id)])
+    for scope, retry_after in zip(('connection', 'room'), waits):
+        if retry_after:
+            return {"msg": "Too many messages, slow down", "event": event, "scope": scope,
+                    "retry_after": round(retry_after, 3)}
+    return None
+
+
+def send_room_message(room_id, text):
+    # Chat lines are kept in the room's history first, then sent with their sequence number
+    # as a second argument, which clients pass back to resume after a reconnect
+    seq = chat_history.append(room_id, 'message', {"text": text})
+    broadcast(room_id, 'message', text, seq)
+
+
+# Servants waiting for a session, ordered by skill
+servant_queue = make_servant_queue(shared_redis)
+
+# Namespace of the per-servant advisory locks taken while booking a servant
+SERVANT_LOCK_NAMESPACE = 5001
+
+
+def servant_is_busy(servant_id):
+    # Active in Postgres and not ended in Redis, where session ends are recorded first
+    active_session_ids = db.session.scalars(
+        db.select(Session.id).where(Session.servant_id == servant_id, Session.end_timestamp.is_(None)))
+    for session_id in active_session_ids:
+        state = session_store.session(session_id)
+        if state is None or not state['ended']:
+            return True
+    return False
+
+
+def book_servant(princess_id, princess_mood, servant_id, servant_skill):
+    # Start a session unless the servant is busy. Bookings of one servant are serialized across
+    # nodes by a transaction-scoped advisory lock, so two princesses never both see the servant free.
+    db.session.execute(db.text("SELECT pg_advisory_xact_lock(:namespace, :servant_id)"),
+                       {"namespace": SERVANT_LOCK_NAMESPACE, "servant_id": servant_id})
+    if servant_is_busy(servant_id):
+        db.session.rollback()
+        return None
+
+    new_session = Session(
+        princess_id=princess_id,
+        servant_id=servant_id,
+        start_timestamp=db.func.now(),
+        host_port = int(os.getenv('PORT'))
+    )
+    db.session.add(new_session)
+    db.session.commit()
+    servant_queue.remove(servant_id)
+    session_activity.touch(new_session.id)
+
+    # Later reads of this session are served from Redis
+    session_store.cache_session(new_session.id, {
+        "princess_id": princess_id,
+        "servant_id": servant_id,
+        "host_port": new_session.host_port,
+        "princess_mood": princess_mood,
+        "servant_skill": servant_skill,
+        "open_requests": 0,
+        "ended": False
+    })
+    push_events({"type": "session_started", "session_id": new_session.id, "princess_id": princess_id,
+                 "servant_id": servant_id, "mood": princess_mood, "skill": servant_skill})
+    return new_session
+
+
+def create_app():
+    global session_flusher, engine_started, reaper_started, chat_flusher_started, batcher_started, \
+        members_refresher_started
+
+    # Startup only checks the schema version, pending migrations run once under an advisory lock
+    with app.app_context():
+        ensure_schema(db.engine, auto_migrate=os.getenv('MIGRATE_ON_START', 'true').lower() == 'true')
+        task_catalog.load()
+
+    # Every node runs a flusher, the leader lock lets one of them write at a time
+    if session_store.enabled and session_flusher is None:
+        session_flusher = JournalFlusher(redis_client, persist_session_ends,
+                                         batch_size=int(os.getenv('SESSION_FLUSH_BATCH_SIZE', '1000')))
+        socketio.start_background_task(session_flusher.run, socketio.sleep,
+                                       float(os.getenv('SESSION_FLUSH_INTERVAL', '1')))
+
+    # Buffered chat messages are written out on a normal interpreter exit too (gunicorn
+    # workers flush from the worker_exit hook, see gunicorn.conf.py)
+    if not chat_flusher_started:
+        chat_flusher_started = True
+        socketio.start_background_task(chat_buffer.run, socketio.sleep)
+        atexit.register(chat_buffer.close)
+
+    if BROADCAST_BATCH_WINDOW and not batcher_started:
+        batcher_started = True
+        socketio.start_background_task(broadcast_batcher.run, socketio.sleep)
+
+    if shared_redis is not None and not members_refresher_started:
+        members_refresher_started = True
+        socketio.start_background_task(sub_room_members.run, socketio.sleep)
+
+    if SIM_ENGINE and not engine_started:
+        engine_started = True
+        socketio.start_background_task(run_tick_engine)
+
+    if SIM_REAPER and not reaper_started:
+        reaper_started = True
+        socketio.start_background_task(run_reaper)
+    return app
+
+@app.cli.command('migrate')
+def migrate_command():
+    # Apply pending schema migrations: flask --app sim_service migrate
+    migrate(db.engine)
+
+@app.cli.command('add-task')
+@click.argument('name')
+def add_task_command(name):
+    # Add a task to the catalog and make every node reload it: flask --app sim_service add-task "Fetch tea"
+    new_task = Tasks(name=name)
+    db.session.add(new_task)
+    db.session.commit()
+    task_catalog.invalidate()
+    click.echo(new_task.id)
+
+@app.cli.command('reload-tasks')
+def reload_tasks_command():
+    # Make every node reload the catalog after tasks were changed in the database directly.
+    # Only needed with Redis, without it the nodes notice the change to the table themselves.
+    task_catalog.invalidate()
 
 import jwt as PyJWT
 
@@ -91,141 +690,192 @@ def process_jwt(token):
         decoded_payload = PyJWT.decode(token, os.getenv('JWT_SECRET_KEY'), algorithms=["HS256"])
         return decoded_payload.get("sub")
 
-    except jwt.ExpiredSignatureError:
+    except PyJWT.ExpiredSignatureError:
         return None
-    except jwt.InvalidTokenError:
+    except PyJWT.InvalidTokenError:
         return None
 
 
+def get_connection_context():
+    # Auth and role resolved once by handle_connect, kept in this sid's Socket.IO session
+    return socket_session['context']
+
+
+# Authenticating a connection once, when it is opened
+@socketio.on('connect')
+def handle_connect(auth):
+
+    # Get room, as the canonical session id used for room names and cache keys
+    if not request.args.get('room_id'):
+        raise ConnectionRefusedError('room_id was not provided!')
+    try:
+        room_id = int(request.args['room_id'])
+    except ValueError:
+        raise ConnectionRefusedError('room_id must be a session id!')
+    if not 0 < room_id < 2 ** 31:
+        raise ConnectionRefusedError('Session not found!')
+
+    # Check room
+    session = load_session_state(room_id)
+    if not session:
+        raise ConnectionRefusedError('Session not found!')
+    if session['ended']:
+        raise ConnectionRefusedError('Session has ended!')
+    # In scale-out mode host_port is only a routing hint, any node can serve the room
+    if not SCALE_OUT and session['host_port'] != int(os.getenv('PORT')):
+        raise ConnectionRefusedError('Session is hosted on another node', {"host_port": session['host_port']})
+
+    # Check user
+    token = request.headers.get('Authorization', '').split(' ')[-1] or (auth or {}).get('token')
+    user_id = process_jwt(token) if token else None
+    if user_id is None:
+        raise ConnectionRefusedError('ERROR: This is an unauthorized access attempt!')
+
+    # Get role: only the session's own princess and servant may join its room
+    character = load_character(user_id)
+    if character['princess_id'] and character['princess_id'] == session['princess_id']:
+        role, char_id = "Princess", character['princess_id']
+    elif character['servant_id'] and character['servant_id'] == session['servant_id']:
+        role, char_id = "Servant", character['servant_id']
+    else:
+        raise ConnectionRefusedError('ERROR: This is an unauthorized access attempt!')
+
+    socket_session['context'] = {
+        "user_id": user_id,
+        "room_id": str(room_id),
+        "role": role,
+        "char_id": char_id,
+        # Broadcast batching and MessagePack, granted when the client asks and the server has them on
+        "batch": bool(BROADCAST_BATCH_WINDOW) and request.args.get('batch', '').lower() in ('1', 'true'),
+        "encoding": 'msgpack' if SOCKET_MSGPACK and request.args.get('encoding') == 'msgpack' else 'json'
+    }
+    # Clients that asked for options learn which ones they got
+    if 'batch' in request.args or 'encoding' in request.args:
+        context = socket_session['context']
+        emit('negotiated', {"batch": context['batch'], "encoding": context['encoding']})
+
+
 # Handling a user joining a room
 @socketio.on('join_room')
 def handle_join(data):
-
-    # Get room
-    room_id = request.args.get('room_id')
-    if not room_id:
-        send('ERROR: room_id was not provided!')
-        disconnect()
-        return
-    
-    # Check room
-    session = Session.query.filter_by(id=room_id).first()
-    if not session or session.host_port != int(os.getenv('PORT')):
-        send(f'{session.host_port}')
-        disconnect()
+    context = get_connection_context()
+    room_id = context['room_id']
+
+    room = client_room(context)
+    join_room(room)
+    if room != room_id and 'sub_room' not in socket_session:
+        socket_session['sub_room'] = room
+        sub_room_members.join(room)
+    session_activity.touch(room_id)
+
+    # Announced once per connection, and only while the room's limits allow it
+    if socket_session.get('announced'):
         return
-    
-    # Check user
-    token = request.headers.get('Authorization')
-    user_id = process_jwt(token.split(' ')[1])
-    char_details = None
-    char_details = ServantDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        char_details = PrincessDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        send(f'{user_id}, {session.princess_id}, {session.servant_id}')
-        disconnect()
+    throttled = message_throttle(room_id, 'join_room')
+    if throttled:
+        emit('throttled', throttled)
         return
-    
-    # Get role
-    role = None
-    try:
-        mood_level = char_details.mood_level
-        role = "Princess"
-    except AttributeError:
-        role = "Servant"
-    
-    join_room(room_id)
-    send(f'{role} has connected.', room=room_id, broadcast=True)
+    socket_session['announced'] = True
+    send_room_message(room_id, f'{context["role"]} has connected.')
+
 
+def session_ended(session_id):
+    # Ends are seen from the shared session state, one Redis read. Without Redis every client
+    # is on this node and was disconnected when the session ended.
+    state = session_store.session(session_id)
+    return state is not None and state['ended']
 
 # Handling messages sent to a room
 @socketio.on('send_message')
 def handle_message(data):
+    context = get_connection_context()
+    room_id = context['room_id']
 
-    # Get room
-    room_id = request.args.get('room_id')
-    if not room_id:
-        send('ERROR: room_id was not provided!')
-        disconnect()
-        return
-    
-    # Check room
-    session = Session.query.filter_by(id=room_id).first()
-    if not session or session.host_port != int(os.getenv('PORT')):
-        send('ERROR: This is an unauthorized access attempt! (1)')
-        disconnect()
-        return
-    
-    # Check user
-    token = request.headers.get('Authorization')
-    user_id = process_jwt(token.split(' ')[1])
-    char_details = None
-    char_details = ServantDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        char_details = PrincessDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        send(f'{user_id}, {session.princess_id}, {session.servant_id}')
-        disconnect()
-        return
-    
-    # Get role
-    role = None
-    try:
-        mood_level = char_details.mood_level
-        role = "Princess"
-    except AttributeError:
-        role = "Servant"
+    message = data.get('message') if isinstance(data, dict) else None
+    # Postgres text cannot hold NUL characters
+    if not isinstance(message, str) or '\x00' in message or len(message) > CHAT_MESSAGE_MAX_LENGTH:
+        return {"msg": f'message must be a string of at most {CHAT_MESSAGE_MAX_LENGTH} characters without NUL'}
 
-    message = data['message']
-    
-    send(f'{role}: {message}', room=room_id, broadcast=True)
+    if session_ended(room_id):
+        return {"msg": "Session has ended"}
+
+    # Limits are checked before anything is kept or broadcast
+    throttled = message_throttle(room_id)
+    if throttled:
+        emit('throttled', throttled)
+        return throttled
+    session_activity.touch(room_id)
+
+    # Backpressure: the transcript buffer stayed full, the sender has to send again later
+    if not chat_buffer.add({"session_id": int(room_id), "user_id": int(context['user_id']), "role": context['role'],
+                            "message": message, "sent_at": datetime.datetime.utcnow()}):
+        return {"msg": "Chat is busy, please send the message again"}
+
+    send_room_message(room_id, f'{context["role"]}: {message}')
 
 
 # Handling a user leaving a room
 @socketio.on('leave_room')
 def handle_disconnect(data):
+    context = get_connection_context()
+    room_id = context['room_id']
 
-   # Get room
-    room_id = request.args.get('room_id')
-    if not room_id:
-        send('ERROR: room_id was not provided!')
-        disconnect()
-        return
-    
-    # Check room
-    session = Session.query.filter_by(id=room_id).first()
-    if not session or session.host_port != int(os.getenv('PORT')):
-        send('ERROR: This is an unauthorized access attempt! (1)')
-        disconnect()
-        return
-    
-    # Check user
-    token = request.headers.get('Authorization')
-    user_id = process_jwt(token.split(' ')[1])
-    char_details = None
-    char_details = ServantDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        char_details = PrincessDetails.query.filter_by(user_id=user_id).first()
-    if not char_details:
-        send(f'{user_id}, {session.princess_id}, {session.servant_id}')
-        disconnect()
-        return
-    
-    # Get role
-    role = None
-    try:
-        mood_level = char_details.mood_level
-        role = "Princess"
-    except AttributeError:
-        role = "Servant"
+    leave_room(client_room(context))
 
-    leave_room(room_id)
-    
-    send(f'{role} has disconnected.', room=room_id, broadcast=True)
+    if socket_session.get('announced') and not message_throttle(room_id, 'leave_room'):
+        send_room_message(room_id, f'{context["role"]} has disconnected.')
 
     disconnect()
 
+# Connections that joined a sub-room stop counting as its members when they go away
+@socketio.on('disconnect')
+def handle_disconnected(*args):
+    room = socket_session.pop('sub_room', None)
+    if room is not None:
+        sub_room_members.leave(room)
+
+def sequence_after(data):
+    # The last sequence number a catching-up client saw, None when the payload has no valid one
+    after = data.get('after', 0) if isinstance(data, dict) else None
+    return after if is_id(after) and after >= 0 else None
+
+# Catching up after a reconnect: the room events after the client's last sequence number,
+# returned as the acknowledgement. complete is false when older events were already trimmed.
+@socketio.on('sync')
+def handle_sync(data):
+    context = get_connection_context()
+    after = sequence_after(data)
+    if after is None:
+        return {"msg": "after must be a sequence number"}
+
+    entries, complete = room_events.since(context['room_id'], after, ROOM_SYNC_LIMIT)
+    return {
+        "events": [{"event": event, "data": dict(payload, session_id=int(context['room_id']), seq=seq)}
+                   for seq, event, payload in entries],
+        "complete": complete
+    }
+
+# Catching up on chat after a reconnect: the room's messages after the client's last-seen
+# sequence number are replayed to this client only, in order, and the acknowledgement says
+# how many were replayed. complete is false when older messages were already trimmed.
+@socketio.on('resume')
+def handle_resume(data):
+    context = get_connection_context()
+    after = sequence_after(data)
+    if after is None:
+        return {"msg": "after must be a sequence number"}
+
+    entries, complete = chat_history.since(context['room_id'], after, CHAT_RESUME_LIMIT)
+    for seq, _, payload in entries:
+        send_to_client(context, 'message', payload['text'], seq)
+    return {"replayed": len(entries), "complete": complete}
+
+# Asking this worker's clients to reconnect elsewhere, so a shutdown can drain
+def drain_connections():
+    for sid, eio_sid in list(socketio.server.manager.get_participants('/', None)):
+        socketio.server.emit('server_shutdown', {"msg": "Server is shutting down, please reconnect"}, to=sid, ignore_queue=True)
+        socketio.server.disconnect(sid, ignore_queue=True)
+
 def register_with_consul(service_name, service_id, service_port):
     url = "http://localhost:8500/v1/agent/sim/register"
     data = {
@@ -241,6 +891,15 @@ def register_with_consul(service_name, service_id, service_port):
 def status():
     return jsonify({"status": "Simulation service is up and running!"}), 200
 
+# Listing the task catalog, cacheable by clients and the gateway through its ETag
+@app.route('/simulation/tasks', methods=['GET'])
+def list_tasks():
+    tasks = task_catalog.tasks()
+    response = jsonify({"tasks": [{"id": task_id, "name": name} for task_id, name in sorted(tasks.items())]})
+    response.set_etag(task_catalog.etag())
+    response.headers['Cache-Control'] = 'no-cache'  # Revalidate every time, a 304 costs no database work
+    return response.make_conditional(request)
+
 @app.route('/simulation/add_user', methods=['POST'])
 @jwt_required()
 def add_user():
@@ -262,6 +921,7 @@ def add_user():
         new_princess = PrincessDetails(user_id=user_id, mood_level=50)
         db.session.add(new_princess)
         db.session.commit()
+        session_store.forget_character(user_id)
 
         return jsonify({"msg": "Princess created successfully", "princess_id": new_princess.id}), 201
     else:
@@ -273,6 +933,7 @@ def add_user():
         new_servant = ServantDetails(user_id=user_id, skill_level=1)
         db.session.add(new_servant)
         db.session.commit()
+        session_store.forget_character(user_id)
 
         return jsonify({"msg": "Servant created successfully", "servant_id": new_servant.id}), 201
 
@@ -307,6 +968,10 @@ def get_servant_details():
         "skill_level": servant.skill_level,
     })
 
+def is_id(value):
+    # Ids from a JSON body must be integers, and bool is an int to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
 @app.route('/simulation/request/task', methods=['POST'])
 @jwt_required()
 def request_task():
@@ -315,38 +980,96 @@ def request_task():
 
     task_id = data.get('task_id')
     session_id = data.get('session_id')  # Assume we get a valid session_id from the client
-    princess = PrincessDetails.query.filter_by(user_id=user_id).first()
-    # Validate the task
-    task = Tasks.query.filter_by(id=task_id).first()
-    if not task:
+
+    # Princess and session come from the live state in Redis
+    princess_id = load_character(user_id)['princess_id']
+    if not princess_id:
+        return jsonify({"msg": "Princess details not found"}), 404
+
+    # Validate the task against the cached catalog
+    if not is_id(task_id) or task_id not in task_catalog.tasks():
         return jsonify({"msg": "Invalid task ID"}), 400
 
     # Validate the session
-    session = Session.query.filter_by(id=session_id, end_timestamp=None).first()
-    if not session:
+    session = load_session_state(session_id) if is_id(session_id) else None
+    if not session or session['ended']:
         return jsonify({"msg": "Invalid session or session not found"}), 404
-    servant = ServantDetails.query.filter_by(user_id=session.servant_id).first()
-
-    # Create a new request
-    new_request = Request(
-        task_id=task_id,
-        princess_id=princess.id,  # Assuming user_id matches princess_details_id
-        servant_id=servant.id,
-        session_id=session_id,
-        timestamp=db.func.now() 
-    )
-    db.session.add(new_request)
+
+    # Create the request and its log entry in one transaction
+    new_request_id, new_log_id = create_requests(princess_id, session['servant_id'], session_id, [task_id])[0]
     db.session.commit()
+    session_store.add_open_requests(session_id, 1)
+    session_activity.touch(session_id)
+    push_events({"type": "requests_opened", "session_id": session_id, "count": 1})
+    publish_room_events([(session_id, 'task_requested', {"requests": [
+        {"request_id": new_request_id, "log_id": new_log_id, "task_id": task_id, "task_name": task_catalog.tasks().get(task_id)}
+    ]})])
 
-    # Create a log entry in SessionLog for the new request
-    new_log = SessionLog(
-        session_id=session.id,
-        request_id=new_request.id
-    )
-    db.session.add(new_log)
+    return jsonify({"msg": "Task request created and logged", "request_id": new_request_id, "log_id": new_log_id}), 201
+
+
+# Creating a burst of task requests for one session at once
+@app.route('/simulation/request/tasks', methods=['POST'])
+@jwt_required()
+def request_tasks():
+    user_id = get_jwt_identity()
+    data = request.get_json()
+
+    task_ids = data.get('task_ids') or []
+    session_id = data.get('session_id')
+
+    if not task_ids:
+        return jsonify({"msg": "Missing 'task_ids' field in request data"}), 400
+    if not isinstance(task_ids, list):
+        return jsonify({"msg": "'task_ids' must be a list of task IDs"}), 400
+    if len(task_ids) > REQUEST_BATCH_LIMIT:
+        return jsonify({"msg": f"At most {REQUEST_BATCH_LIMIT} tasks per batch"}), 400
+
+    princess_id = load_character(user_id)['princess_id']
+    if not princess_id:
+        return jsonify({"msg": "Princess details not found"}), 404
+
+    # Validate every task against the cached catalog, the batch is all or nothing
+    known_task_ids = task_catalog.tasks()
+    invalid_task_ids = [task_id for task_id in task_ids if not is_id(task_id) or task_id not in known_task_ids]
+    if invalid_task_ids:
+        return jsonify({"msg": "Invalid task ID", "task_ids": invalid_task_ids}), 400
+
+    session = load_session_state(session_id) if is_id(session_id) else None
+    if not session or session['ended']:
+        return jsonify({"msg": "Invalid session or session not found"}), 404
+
+    created = create_requests(princess_id, session['servant_id'], session_id, task_ids)
     db.session.commit()
+    session_store.add_open_requests(session_id, len(task_ids))
+    session_activity.touch(session_id)
+    push_events({"type": "requests_opened", "session_id": session_id, "count": len(task_ids)})
+    tasks = task_catalog.tasks()
+    publish_room_events([(session_id, 'task_requested', {"requests": [
+        {"request_id": request_id, "log_id": log_id, "task_id": task_id, "task_name": tasks.get(task_id)}
+        for task_id, (request_id, log_id) in zip(task_ids, created)
+    ]})])
 
-    return jsonify({"msg": "Task request created and logged", "request_id": new_request.id, "log_id": new_log.id}), 201
+    return jsonify({
+        "msg": "Task requests created and logged",
+        "requests": [{"task_id": task_id, "request_id": request_id, "log_id": log_id}
+                     for task_id, (request_id, log_id) in zip(task_ids, created)]
+    }), 201
+
+
+def create_requests(princess_id, servant_id, session_id, task_ids):
+    # One multi-row INSERT for the requests and one for their log entries, in the caller's transaction.
+    # Returns (request_id, log_id) pairs in the order of task_ids.
+    request_ids = db.session.scalars(
+        db.insert(Request).returning(Request.id, sort_by_parameter_order=True),
+        [{"task_id": task_id, "princess_id": princess_id, "servant_id": servant_id, "session_id": session_id}
+         for task_id in task_ids]
+    ).all()
+    log_ids = db.session.scalars(
+        db.insert(SessionLog).returning(SessionLog.id, sort_by_parameter_order=True),
+        [{"session_id": session_id, "request_id": request_id} for request_id in request_ids]
+    ).all()
+    return list(zip(request_ids, log_ids))
 
 
 @app.route('/simulation/session/start', methods=['POST'])
@@ -356,53 +1079,116 @@ def start_session():
     data = request.get_json()
 
     servant_id = data.get('servant_id')
+    if not is_id(servant_id):
+        return jsonify({"msg": "Servant details not found"}), 404
 
-    princess = PrincessDetails.query.filter_by(user_id=user_id).first()
+    # Princess and servant in one query
+    lookup = db.session.execute(
+        db.select(PrincessDetails.id, PrincessDetails.mood_level, ServantDetails.skill_level)
+        .select_from(PrincessDetails)
+        .outerjoin(ServantDetails, ServantDetails.id == servant_id)
+        .where(PrincessDetails.user_id == user_id)
+    ).first()
     
-    if not princess:
+    if not lookup:
         return jsonify({"msg": "Princess details not found"}), 404
+    princess_id, princess_mood, servant_skill = lookup
+    if servant_skill is None:
+        return jsonify({"msg": "Servant details not found"}), 404
     
     # Start a new session
-    new_session = Session(
-        princess_id=princess.id,
-        servant_id=servant_id,
-        start_timestamp=db.func.now(),
-        host_port = int(os.getenv('PORT'))
-    )
-    db.session.add(new_session)
-    db.session.commit()
-
-    session_key = f"session:{new_session.id}"
-    session_data = {
-        "princess_mood": princess.mood_level,
-        "servant_skill": 1  # Assuming initial skill level
-    }
+    new_session = book_servant(princess_id, princess_mood, servant_id, servant_skill)
+    if not new_session:
+        return jsonify({"msg": "Servant is already in an active session"}), 409
 
     return jsonify({"msg": "Session started", "session_id": new_session.id, "host_port": new_session.host_port}), 201
 
 
+# Assigning the most skilled waiting servant to a princess
+@app.route('/simulation/session/match', methods=['POST'])
+@jwt_required()
+def match_session():
+    user_id = get_jwt_identity()
+
+    princess = db.session.execute(
+        db.select(PrincessDetails.id, PrincessDetails.mood_level).where(PrincessDetails.user_id == user_id)
+    ).first()
+    if not princess:
+        return jsonify({"msg": "Princess details not found"}), 404
+
+    # A popped servant belongs to this call alone. Skip any booked directly in the meantime.
+    while True:
+        best = servant_queue.pop_best()
+        if best is None:
+            return jsonify({"msg": "No servant available"}), 404
+        servant_id, servant_skill = best
+        new_session = book_servant(princess.id, princess.mood_level, servant_id, servant_skill)
+        if new_session:
+            break
+
+    return jsonify({
+        "msg": "Session started",
+        "session_id": new_session.id,
+        "servant_id": servant_id,
+        "host_port": new_session.host_port
+    }), 201
+
+
+# Servants waiting to be matched
+@app.route('/simulation/servant/available', methods=['POST'])
+@jwt_required()
+def servant_available():
+    user_id = get_jwt_identity()
+
+    servant = db.session.execute(
+        db.select(ServantDetails.id, ServantDetails.skill_level).where(ServantDetails.user_id == user_id)
+    ).first()
+    if not servant:
+        return jsonify({"msg": "Servant details not found"}), 404
+    if servant_is_busy(servant.id):
+        return jsonify({"msg": "Servant is already in an active session"}), 409
+
+    servant_queue.add(servant.id, servant.skill_level)
+    return jsonify({"msg": "Servant is waiting for a session"}), 200
+
+@app.route('/simulation/servant/available', methods=['DELETE'])
+@jwt_required()
+def servant_unavailable():
+    servant_id = load_character(get_jwt_identity())['servant_id']
+    if not servant_id:
+        return jsonify({"msg": "Servant details not found"}), 404
+
+    servant_queue.remove(servant_id)
+    return jsonify({"msg": "Servant left the queue"}), 200
+
+
 @app.route('/simulation/session/servants-current', methods=['GET'])
 @jwt_required()
 def get_current_session():
     user_id = get_jwt_identity()  # Get the current user ID from the JWT
 
     # Fetch the servant's details
-    servant = ServantDetails.query.filter_by(user_id=user_id).first()
+    servant_id = load_character(user_id)['servant_id']
     
-    if not servant:
+    if not servant_id:
         return jsonify({"msg": "Servant details not found"}), 404
 
-    # Find the active session for the servant (where end_timestamp is None)
-    session = Session.query.filter_by(servant_id=servant.id, end_timestamp=None).first()
+    # Find the active session for the servant, from Redis first
+    session_id = session_store.servant_session(servant_id)
+    if session_id is None:
+        active_session = Session.query.filter_by(servant_id=servant_id, end_timestamp=None).first()
+        session_id = active_session.id if active_session else None
+    session = load_session_state(session_id) if session_id is not None else None
 
-    if not session:
+    # An end recorded in Redis may not have been written to Postgres yet
+    if not session or session['ended']:
         return jsonify({"msg": "No active session found for the servant"}), 404
 
     # Return the session details as in /simulation/session/start
     return jsonify({
         "msg": "Current session found",
-        "session_id": session.id,
-        "host_port": session.host_port
+        "session_id": session_id,
+        "host_port": session['host_port']
     }), 200
 
 
@@ -412,37 +1198,82 @@ def end_session():
     data = request.get_json()
 
     session_id = data.get('session_id')
-    session = Session.query.filter_by(id=session_id).first()
+    session = load_session_state(session_id) if is_id(session_id) else None
 
-    if not session:
+    if not session or session['ended']:
         return jsonify({"msg": "Session not found or already completed"}), 404
 
-    # End the session
-    session.end_timestamp = db.func.now()
-    db.session.commit()
+    # End the session, written behind to Postgres when Redis holds the live state
+    if not session_store.end_session(session_id, session['servant_id']):
+        Session.query.filter(Session.id == session_id, Session.end_timestamp.is_(None)) \
+            .update({"end_timestamp": db.func.now()})
+        db.session.commit()
+    session_activity.forget([session_id])
+    push_events({"type": "session_ended", "session_id": session_id})
+    close_session_rooms(session_id, 'ended')
 
     return jsonify({"msg": "Session ended"}), 200
 
 
+def session_log_rows(session_id, after):
+    # Log entries with their request and task in one query, in log order from the (session_id, id) index
+    return db.select(SessionLog.id, SessionLog.session_id, SessionLog.request_id,
+                     Request.task_id, Tasks.name, Request.timestamp, Request.success) \
+        .join(Request, Request.id == SessionLog.request_id) \
+        .join(Tasks, Tasks.id == Request.task_id) \
+        .where(SessionLog.session_id == session_id, SessionLog.id > after) \
+        .order_by(SessionLog.id)
+
+def session_log_entry(row):
+    return {
+        "log_id": row.id,
+        "session_id": row.session_id,
+        "request_id": row.request_id,
+        "task_id": row.task_id,
+        "task_name": row.name,
+        "timestamp": row.timestamp,
+        "success": row.success
+    }
+
+def stream_session_logs(session_id, after):
+    # Rows come from a server-side cursor in chunks, so memory stays flat however long the session
+    rows = db.session.execute(session_log_rows(session_id, after).execution_options(stream_results=True, yield_per=1000))
+    try:
+        for row in rows:
+            yield app.json.dumps(session_log_entry(row)) + '\n'
+    finally:
+        # Release the cursor and its transaction as soon as the stream ends
+        db.session.close()
+
 @app.route('/simulation/session/logs', methods=['GET'])
 def get_session_logs():
-    data = request.get_json()
-    session_id = data.get('session_id')
-    
-    session_logs = SessionLog.query.filter_by(session_id=session_id).all()
+    # Keyset pagination: "after" is the last log id of the previous page.
+    # session_id in a JSON body is still accepted from older clients.
+    session_id = request.args.get('session_id', type=int)
+    if session_id is None:
+        session_id = (request.get_json(silent=True) or {}).get('session_id')
+    limit = request.args.get('limit', 100, type=int)
+    after = request.args.get('after', 0, type=int)
+
+    if session_id is None:
+        return jsonify({"msg": "Missing 'session_id' parameter"}), 400
+    if not is_id(session_id):
+        return jsonify({"msg": "session_id must be a session ID"}), 400
+    if limit < 1 or limit > 1000:
+        return jsonify({"msg": "limit must be between 1 and 1000"}), 400
+
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        return Response(stream_with_context(stream_session_logs(session_id, after)), mimetype='application/x-ndjson')
+
+    rows = db.session.execute(session_log_rows(session_id, after).limit(limit)).all()
     
-    if not session_logs:
+    if not rows and not after:
         return jsonify({"msg": "No logs found for this session"}), 404
     
-    logs = []
-    for log in session_logs:
-        logs.append({
-            "log_id": log.id,
-            "session_id": log.session_id,
-            "request_id": log.request_id
-        })
+    logs = [session_log_entry(row) for row in rows]
+    next_cursor = rows[-1].id if len(rows) == limit else None
     
-    return jsonify({"logs": logs}), 200
+    return jsonify({"logs": logs, "next_cursor": next_cursor}), 200
 
 @app.route('/simulation/request/complete', methods=['POST'])
 @jwt_required()
@@ -451,21 +1282,94 @@ def complete_request():
     data = request.get_json()
 
     request_id = data.get('request_id')
-    
-    # Fetch the request to be completed
-    task_request = Request.query.filter_by(id=request_id).first()
+    success = data.get('success', True)  # Servants may report a failed task
+    if not isinstance(success, bool):
+        return jsonify({"msg": "'success' must be true or false"}), 400
+    if not is_id(request_id):
+        return jsonify({"msg": "Request not found or unauthorized"}), 404
+
+    # Complete the request if it is still open and assigned to the caller's servant, in one
+    # statement so concurrent completions cannot both count it
+    completed = db.session.execute(db.text("""
+        UPDATE requests SET success = :success
+        FROM servant_details
+        WHERE requests.id = :id AND requests.success IS NULL
+          AND requests.servant_id = servant_details.id AND servant_details.user_id = :user_id
+        RETURNING requests.session_id
+    """), {"success": success, "id": request_id, "user_id": user_id}).first()
+    db.session.commit()
 
-    if not task_request:
+    if completed is None:
+        assigned = db.session.execute(db.text("""
+            SELECT 1 FROM requests JOIN servant_details ON servant_details.id = requests.servant_id
+            WHERE requests.id = :id AND servant_details.user_id = :user_id
+        """), {"id": request_id, "user_id": user_id}).first()
+        if assigned:
+            return jsonify({"msg": "Request already completed"}), 409
         return jsonify({"msg": "Request not found or unauthorized"}), 404
 
-    # Mark the request as completed
-    task_request.success = True
+    session_id = completed[0]
+    session_activity.touch(session_id)
+    session_store.add_open_requests(session_id, -1)
+    push_events({"type": "request_completed", "session_id": session_id, "success": success})
+    publish_room_events([(session_id, 'task_completed', {"request_ids": [request_id], "success": success})])
+
+    return jsonify({"msg": "Request completed", "request_id": request_id}), 200
+
+# Completing a servant's backlog at once
+@app.route('/simulation/request/complete/batch', methods=['POST'])
+@jwt_required()
+def complete_requests():
+    user_id = get_jwt_identity()
+    data = request.get_json()
+
+    request_ids = data.get('request_ids') or []
+    success = data.get('success', True)
+
+    if not isinstance(success, bool):
+        return jsonify({"msg": "'success' must be true or false"}), 400
+    if not request_ids:
+        return jsonify({"msg": "Missing 'request_ids' field in request data"}), 400
+    if not isinstance(request_ids, list) or not all(is_id(request_id) for request_id in request_ids):
+        return jsonify({"msg": "'request_ids' must be a list of request IDs"}), 400
+    if len(request_ids) > REQUEST_BATCH_LIMIT:
+        return jsonify({"msg": f"At most {REQUEST_BATCH_LIMIT} requests per batch"}), 400
+
+    # One statement completes every open request assigned to the caller's servant
+    completed = db.session.execute(db.text("""
+        UPDATE requests SET success = :success
+        FROM servant_details
+        WHERE requests.id = ANY(:ids) AND requests.success IS NULL
+          AND requests.servant_id = servant_details.id AND servant_details.user_id = :user_id
+        RETURNING requests.id, requests.session_id
+    """), {"success": success, "ids": request_ids, "user_id": user_id}).all()
     db.session.commit()
 
-    return jsonify({"msg": "Request completed", "request_id": task_request.id}), 200
+    by_session = {}
+    for completed_id, session_id in completed:
+        by_session.setdefault(session_id, []).append(completed_id)
+
+    for session_id, completed_ids in by_session.items():
+        session_store.add_open_requests(session_id, -len(completed_ids))
+        session_activity.touch(session_id)
+
+    # One coalesced task_completed event per room instead of one per request
+    publish_room_events([(session_id, 'task_completed', {"request_ids": completed_ids, "success": success})
+                         for session_id, completed_ids in by_session.items()])
+    if completed:
+        push_events(*[{"type": "request_completed", "session_id": session_id, "success": success}
+                      for _, session_id in completed])
+
+    completed_ids = set(completed_id for completed_id, _ in completed)
+    return jsonify({
+        "msg": "Requests completed",
+        "completed": [request_id for request_id in request_ids if request_id in completed_ids],
+        # Unknown, already completed or assigned to another servant
+        "skipped": [request_id for request_id in request_ids if request_id not in completed_ids]
+    }), 200
 
 # Run the Flask p
 if __name__ == '__main__':
-    socketio.run(app, debug=True, port=os.getenv('PORT'), host='0.0.0.0')
+    socketio.run(create_app(), debug=True, port=os.getenv('PORT'), host='0.0.0.0')
     register_with_consul("simulation-service", "simulation-service-id", os.getenv('PORT'))  # For sim_service
 
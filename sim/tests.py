@@ -0,0 +1,803 @@
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import fakeredis
+from sqlalchemy import event, text
+import jwt
+import pytest
+import socketio
+
+DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI', 'postgresql://test_user:test_password@db:5432/test_db')
+JWT_SECRET_KEY = 'your_jwt_secret_key'
+
+
+def make_token(user_id):
+    return jwt.encode({"sub": user_id}, JWT_SECRET_KEY, algorithm="HS256")
+
+
+def add_task(app, name):
+    # Tasks are added by operators through the CLI, which prints the new task's id
+    result = app.test_cli_runner().invoke(args=['add-task', name])
+    assert result.exit_code == 0, result.output
+    return int(result.output)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def fanout_worker(index, ports, queue_url, barrier, user_ids, session_id, results):
+    # Every worker is its own sim-app node on its own port, sharing only Redis and Postgres
+    os.environ.update({
+        "SQLALCHEMY_DATABASE_URI": DATABASE_URI,
+        "JWT_SECRET_KEY": JWT_SECRET_KEY,
+        "PORT": str(ports[index]),
+        "SIM_SCALE_OUT": "true",
+        "SOCKETIO_ASYNC_MODE": "threading",
+        "SOCKETIO_MESSAGE_QUEUE": queue_url
+    })
+    import sim_service
+    sim_service.create_app()
+    threading.Thread(
+        target=sim_service.socketio.run,
+        args=(sim_service.app,),
+        kwargs={"host": "127.0.0.1", "port": ports[index], "allow_unsafe_werkzeug": True},
+        daemon=True
+    ).start()
+    barrier.wait()
+
+    # The first node creates the session, hosted on its own port
+    if index == 0:
+        with sim_service.app.app_context():
+            princess = sim_service.PrincessDetails(user_id=user_ids[0], mood_level=50)
+            servant = sim_service.ServantDetails(user_id=user_ids[1], skill_level=1)
+            sim_service.db.session.add_all([princess, servant])
+            sim_service.db.session.commit()
+            session = sim_service.Session(princess_id=princess.id, servant_id=servant.id, host_port=ports[0])
+            sim_service.db.session.add(session)
+            sim_service.db.session.commit()
+            session_id.value = session.id
+    barrier.wait()
+
+    received = []
+    client = socketio.Client()
+    client.on('message', lambda text, seq=None: received.append(text))
+    client.connect(
+        f'http://127.0.0.1:{ports[index]}?room_id={session_id.value}',
+        headers={"Authorization": f'Bearer {make_token(user_ids[index % 2])}'},
+        transports=['polling'],
+        wait_timeout=10
+    )
+    client.emit('join_room', {})
+    time.sleep(0.5)
+    barrier.wait()
+
+    if index == 0:
+        client.emit('send_message', {"message": "hello from node 0"})
+
+    deadline = time.time() + 10
+    while time.time() < deadline and 'Princess: hello from node 0' not in received:
+        time.sleep(0.05)
+
+    results.put((index, client.connected, received))
+    client.disconnect()
+
+
+@pytest.fixture
+def redis_server():
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'redis://127.0.0.1:{server.server_address[1]}/0'
+    server.shutdown()
+    server.server_close()
+
+
+def test_scale_out_room_fanout(redis_server):
+    workers_count = 3
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers_count)
+    session_id = context.Value('i', 0)
+    results = context.Queue()
+    ports = [free_port() for _ in range(workers_count)]
+    user_ids = [random.randint(1, 10 ** 9), random.randint(1, 10 ** 9)]
+
+    workers = [
+        context.Process(target=fanout_worker, args=(index, ports, redis_server, barrier, user_ids, session_id, results))
+        for index in range(workers_count)
+    ]
+    for worker in workers:
+        worker.start()
+
+    outcomes = dict((index, (connected, received)) for index, connected, received in
+                    [results.get(timeout=60) for _ in workers])
+    for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+            worker.terminate()
+
+    # Nodes 1 and 2 do not host the session, yet they accept the clients and get the broadcast
+    for index in range(workers_count):
+        connected, received = outcomes[index]
+        assert connected
+        assert 'Princess: hello from node 0' in received
+
+
+def seed_large_dataset(db, user_base):
+    # Enough rows that the planner prefers an index for every selective lookup
+    db.session.execute(text("""
+        INSERT INTO princess_details (user_id, mood_level)
+            SELECT :base + n, 50 FROM generate_series(1, 20000) AS n;
+        INSERT INTO servant_details (user_id, skill_level)
+            SELECT :base + n, 1 FROM generate_series(1, 20000) AS n;
+        INSERT INTO tasks (name) SELECT 'task ' || n FROM generate_series(1, 1000) AS n;
+        INSERT INTO sessions (start_timestamp, end_timestamp, princess_id, servant_id, host_port)
+            SELECT now(), CASE WHEN p.id % 10 = 0 THEN NULL ELSE now() END, p.id, s.id, 5000
+            FROM princess_details p JOIN servant_details s ON s.user_id = p.user_id
+            WHERE p.user_id > :base;
+        INSERT INTO requests (timestamp, task_id, success, session_id, princess_id, servant_id)
+            SELECT now(), (SELECT min(id) FROM tasks), NULL, s.id, s.princess_id, s.servant_id
+            FROM sessions s, generate_series(1, 3);
+        INSERT INTO session_log (session_id, request_id) SELECT session_id, id FROM requests;
+    """), {"base": user_base})
+    db.session.commit()
+    for table in ['princess_details', 'servant_details', 'tasks', 'sessions', 'requests', 'session_log']:
+        db.session.execute(text(f"ANALYZE {table}"))
+    db.session.commit()
+
+
+def plan_node_types(plan):
+    yield plan['Node Type']
+    for child in plan.get('Plans', []):
+        yield from plan_node_types(child)
+
+
+def test_routes_avoid_sequential_scans(sim_users):
+    from flask_jwt_extended import create_access_token
+
+    # The fixture's users are not used, these ones come after the seeded rows
+    sim_service, app, db = sim_users.service, sim_users.app, sim_users.service.db
+    user_base = random.randint(10 ** 9, 2 * 10 ** 9)
+    with app.app_context():
+        seed_large_dataset(db, user_base)
+        princess_user, servant_user = user_base + 30001, user_base + 30002
+        princess_token = create_access_token(identity=princess_user)
+        servant_token = create_access_token(identity=servant_user)
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            # Whole-table reads such as the task catalog load scan by design, only lookups need an index
+            if statement.lstrip().split(' ', 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE') and 'WHERE' in statement:
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            client = app.test_client()
+            princess = {"Authorization": f'Bearer {princess_token}'}
+            servant = {"Authorization": f'Bearer {servant_token}'}
+            task_id = add_task(app, "Fetch tea")
+            assert client.post('/simulation/add_user', json={"is_princess": True}, headers=princess).status_code == 201
+            servant_id = client.post('/simulation/add_user', json={"is_princess": False}, headers=servant).get_json()['servant_id']
+            assert client.get('/simulation/princess/details', headers=princess).status_code == 200
+            assert client.get('/simulation/servant/details', headers=servant).status_code == 200
+            session_id = client.post('/simulation/session/start', json={"servant_id": servant_id}, headers=princess).get_json()['session_id']
+
+            assert client.post('/simulation/servant/available', json={}, headers=servant).status_code == 409
+            assert client.post('/simulation/session/match', json={}, headers=princess).status_code in (201, 404)
+
+            socket_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=servant)
+            assert socket_client.is_connected()
+            socket_client.emit('join_room', {})
+
+            response = client.post('/simulation/request/task', json={"task_id": task_id, "session_id": session_id}, headers=princess)
+            assert response.status_code == 201
+            request_id = response.get_json()['request_id']
+            response = client.post('/simulation/request/tasks', json={"task_ids": [task_id] * 3, "session_id": session_id}, headers=princess)
+            assert response.status_code == 201
+            batch_ids = [created['request_id'] for created in response.get_json()['requests']]
+            assert len(batch_ids) == 3
+            assert client.get('/simulation/session/servants-current', headers=servant).status_code == 200
+            assert client.get('/simulation/session/logs', json={"session_id": session_id}).status_code == 200
+            response = client.get(f'/simulation/session/logs?session_id={session_id}&limit=2')
+            assert [log['task_name'] for log in response.get_json()['logs']] == ['Fetch tea', 'Fetch tea']
+            response = client.get(f'/simulation/session/logs?session_id={session_id}&after={response.get_json()["next_cursor"]}&limit=2')
+            assert len(response.get_json()['logs']) == 2 and response.get_json()['next_cursor'] is not None
+            response = client.get(f'/simulation/session/logs?session_id={session_id}&format=ndjson')
+            assert len(response.get_data(as_text=True).splitlines()) == 4
+            response.close()
+            assert client.post('/simulation/request/complete', json={"request_id": request_id}, headers=servant).status_code == 200
+
+            # Only the servant's own open requests are completed, with one room message for the batch
+            response = client.post('/simulation/request/complete/batch', json={"request_ids": batch_ids}, headers=princess)
+            assert response.get_json()['completed'] == []
+            socket_client.get_received()
+            response = client.post('/simulation/request/complete/batch', json={"request_ids": batch_ids + [request_id]}, headers=servant)
+            assert response.get_json()['completed'] == batch_ids and response.get_json()['skipped'] == [request_id]
+            received = [packet for packet in socket_client.get_received() if packet['name'] == 'task_completed']
+            assert len(received) == 1 and received[0]['args'][0]['request_ids'] == batch_ids
+
+            # Every typed room event is numbered, a reconnecting client gets what it missed
+            last_seq = received[0]['args'][0]['seq']
+            synced = socket_client.emit('sync', {"after": last_seq - 2}, callback=True)
+            assert [entry['event'] for entry in synced['events']] == ['task_completed', 'task_completed']
+            assert synced['events'][-1]['data']['seq'] == last_seq and synced['complete']
+            socket_client.disconnect()
+            assert client.post('/simulation/session/end', json={"session_id": session_id}, headers=princess).status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        assert statements
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in statements:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+                plan = cursor.fetchone()[0][0]['Plan']
+                assert 'Seq Scan' not in list(plan_node_types(plan)), statement
+            connection.rollback()
+        finally:
+            connection.close()
+
+
+@pytest.fixture
+def sim_users():
+    # A sim app with one princess and one servant registered through the API
+    os.environ.setdefault('SQLALCHEMY_DATABASE_URI', DATABASE_URI)
+    os.environ.setdefault('JWT_SECRET_KEY', JWT_SECRET_KEY)
+    os.environ.setdefault('PORT', '5000')
+    import sim_service
+    from flask_jwt_extended import create_access_token
+
+    app = sim_service.create_app()
+    client = app.test_client()
+    with app.app_context():
+        princess = {"Authorization": f'Bearer {create_access_token(identity=random.randint(1, 10 ** 9))}'}
+        servant = {"Authorization": f'Bearer {create_access_token(identity=random.randint(1, 10 ** 9))}'}
+    client.post('/simulation/add_user', json={"is_princess": True}, headers=princess)
+    servant_id = client.post('/simulation/add_user', json={"is_princess": False}, headers=servant).get_json()['servant_id']
+    return SimpleNamespace(service=sim_service, app=app, client=client, princess=princess, servant=servant,
+                           servant_id=servant_id)
+
+
+@pytest.fixture
+def sim_session(sim_users):
+    # The same, with a session started between the two
+    sim_users.session_id = sim_users.client.post('/simulation/session/start', json={"servant_id": sim_users.servant_id},
+                                                 headers=sim_users.princess).get_json()['session_id']
+    return sim_users
+
+
+def test_task_catalog_etag(sim_users):
+    sim_service, app, client = sim_users.service, sim_users.app, sim_users.client
+
+    response = client.get('/simulation/tasks')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert client.get('/simulation/tasks', headers={"If-None-Match": etag}).status_code == 304
+
+    # Adding a task changes the catalog and its ETag, and the new task is valid straight away
+    name = f'Polish the crown {random.randint(1, 10 ** 9)}'
+    assert client.post('/simulation/tasks', json={"name": name}).status_code == 405
+    task_id = add_task(app, name)
+    assert sim_service.task_catalog.tasks()[task_id] == name
+
+    response = client.get('/simulation/tasks', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert {"id": task_id, "name": name} in response.get_json()['tasks']
+
+    # Without Redis a node sees tasks changed by another process through the table's checksum
+    from catalog import TaskCatalog
+
+    with app.app_context():
+        catalog = TaskCatalog(sim_service.load_task_catalog, load_version=sim_service.load_task_catalog_version,
+                              check_interval=0)
+        assert catalog.tasks()[task_id] == name
+        sim_service.db.session.execute(sim_service.db.text("UPDATE tasks SET name = 'Polish the throne' WHERE id = :id"),
+                                       {"id": task_id})
+        sim_service.db.session.commit()
+        assert catalog.tasks()[task_id] == 'Polish the throne'
+
+
+def test_session_state_write_behind(sim_users, monkeypatch):
+    from session_state import SessionStore, JournalFlusher
+
+    sim_service, app, client = sim_users.service, sim_users.app, sim_users.client
+    princess, servant, servant_id = sim_users.princess, sim_users.servant, sim_users.servant_id
+    redis_client = fakeredis.FakeStrictRedis()
+    store = SessionStore(redis_client)
+    monkeypatch.setattr(sim_service, 'session_store', store)
+    session_id = client.post('/simulation/session/start', json={"servant_id": servant_id}, headers=princess).get_json()['session_id']
+    task_id = add_task(app, "Brush the pony")
+    assert client.post('/simulation/request/task', json={"task_id": task_id, "session_id": session_id}, headers=princess).status_code == 201
+
+    state = store.session(session_id)
+    assert state['servant_id'] == servant_id and state['open_requests'] == 1 and not state['ended']
+    assert client.get('/simulation/session/servants-current', headers=servant).get_json()['session_id'] == session_id
+
+    # The end lands in Redis and the journal, Postgres only sees it once flushed
+    assert client.post('/simulation/session/end', json={"session_id": session_id}, headers=princess).status_code == 200
+    assert client.get('/simulation/session/servants-current', headers=servant).status_code == 404
+    with app.app_context():
+        assert sim_service.db.session.get(sim_service.Session, session_id).end_timestamp is None
+
+    # A leader that crashes mid-batch leaves its entries to be replayed by the next one
+    def crash(entries):
+        raise RuntimeError('flusher died')
+
+    with pytest.raises(RuntimeError):
+        JournalFlusher(redis_client, crash).flush()
+    assert redis_client.llen('sessions:journal') == 0
+    redis_client.delete('sessions:journal:leader')  # The crashed leader's lock expires
+
+    flusher = JournalFlusher(redis_client, sim_service.persist_session_ends)
+    assert flusher.flush() == 1
+    assert redis_client.llen('sessions:journal:processing') == 0
+    with app.app_context():
+        sim_service.db.session.expire_all()
+        assert sim_service.db.session.get(sim_service.Session, session_id).end_timestamp is not None
+
+    # An idle journal costs an LLEN, not a pipeline of batch_size LMOVEs
+    monkeypatch.setattr(redis_client, 'pipeline', lambda *args, **kwargs: pytest.fail('pipelined on an empty journal'))
+    assert flusher.flush() == 0
+
+
+def test_tick_engine():
+    from engine import TickEngine
+
+    engine = TickEngine(capacity=2, pending_penalty=1.0, failed_penalty=5.0, completed_bonus=2.0)
+    engine.add_sessions([10, 11], [100, 101], [200, 201], [50, 50], [1, 1], [0, 2])
+    engine.apply_events([
+        {"type": "session_started", "session_id": 12, "princess_id": 102, "servant_id": 202, "mood": 50, "skill": 1},
+        {"type": "requests_opened", "session_id": 10, "count": 2},
+        {"type": "request_completed", "session_id": 10, "success": True},
+        {"type": "request_completed", "session_id": 11, "success": False},
+        {"type": "session_ended", "session_id": 99}
+    ])
+
+    changes = engine.tick()
+    session_ids, princess_ids, moods = changes['moods']
+    # Session 10: +2 for the completed task, -1 for the one still pending. Session 11: -5 failed, -1 pending.
+    assert dict(zip(session_ids.tolist(), moods.tolist())) == {10: 51, 11: 44}
+    assert princess_ids.tolist() == [100, 101]
+    session_ids, servant_ids, skills = changes['skills']
+    assert (session_ids.tolist(), servant_ids.tolist(), skills.tolist()) == ([10], [200], [2])
+    # Only session 11's mood left its band of 10 points, so only its room is told
+    assert [values.tolist() for values in changes['mood_notices']] == [[11], [44]]
+
+    # Only changed levels are reported, ended sessions stop ticking and their slot is reused
+    engine.apply_events([{"type": "session_ended", "session_id": 10}, {"type": "session_ended", "session_id": 11}])
+    assert engine.tick()['moods'][0].tolist() == []
+    engine.add_session(13, 103, 203, 50, 1, pending=100)
+    assert engine.tick()['moods'][2].tolist() == [0]
+    assert len(engine) == 2 and engine.size == 3
+
+    # A new leader's snapshot already holds the pending counts of older events, not their completions
+    engine = TickEngine(capacity=2, pending_penalty=1.0, failed_penalty=5.0, completed_bonus=2.0)
+    engine.add_sessions([20], [120], [220], [50], [1], [1])
+    engine.apply_events([
+        {"type": "requests_opened", "session_id": 20, "count": 1, "at": 99.0},
+        {"type": "request_completed", "session_id": 20, "success": True, "at": 99.0},
+        {"type": "requests_opened", "session_id": 20, "count": 3, "at": 101.0}
+    ], snapshot_at=100.0)
+    assert engine.pending[0] == 4 and engine.completed[0] == 1
+
+
+def test_session_match(sim_users):
+    from flask_jwt_extended import create_access_token
+
+    sim_service, app, client = sim_users.service, sim_users.app, sim_users.client
+    with app.app_context():
+        tokens = [{"Authorization": f'Bearer {create_access_token(identity=random.randint(1, 10 ** 9))}'} for _ in range(3)]
+    princesses, servants = [sim_users.princess, tokens[0]], [sim_users.servant] + tokens[1:]
+
+    client.post('/simulation/add_user', json={"is_princess": True}, headers=princesses[1])
+    servant_ids = [sim_users.servant_id] + [
+        client.post('/simulation/add_user', json={"is_princess": False}, headers=headers).get_json()['servant_id']
+        for headers in servants[1:]]
+    with app.app_context():
+        for servant_id, skill in zip(servant_ids, [3, 9, 5]):
+            sim_service.db.session.get(sim_service.ServantDetails, servant_id).skill_level = skill
+        sim_service.db.session.commit()
+    for headers in servants:
+        assert client.post('/simulation/servant/available', json={}, headers=headers).status_code == 200
+
+    # The most skilled servant goes first, and a booked servant cannot be booked again
+    response = client.post('/simulation/session/match', json={}, headers=princesses[0])
+    assert response.status_code == 201
+    assert response.get_json()['servant_id'] == servant_ids[1]
+    assert client.post('/simulation/session/start', json={"servant_id": servant_ids[1]}, headers=princesses[1]).status_code == 409
+    assert client.post('/simulation/servant/available', json={}, headers=servants[1]).status_code == 409
+
+    # Booking a queued servant directly takes them out of the queue
+    assert client.post('/simulation/session/start', json={"servant_id": servant_ids[2]}, headers=princesses[1]).status_code == 201
+    assert client.post('/simulation/session/match', json={}, headers=princesses[1]).get_json()['servant_id'] == servant_ids[0]
+    assert client.post('/simulation/session/match', json={}, headers=princesses[1]).status_code == 404
+
+
+def test_concurrent_booking(sim_users, monkeypatch):
+    from flask_jwt_extended import create_access_token
+
+    sim_service, app = sim_users.service, sim_users.app
+    with app.app_context():
+        other = {"Authorization": f'Bearer {create_access_token(identity=random.randint(1, 10 ** 9))}'}
+    sim_users.client.post('/simulation/add_user', json={"is_princess": True}, headers=other)
+
+    # Both princesses book the same servant at once, with the busy check slowed down so that
+    # without the lock both would find the servant free
+    servant_is_busy = sim_service.servant_is_busy
+
+    def slow_servant_is_busy(servant_id):
+        busy = servant_is_busy(servant_id)
+        time.sleep(0.3)
+        return busy
+
+    monkeypatch.setattr(sim_service, 'servant_is_busy', slow_servant_is_busy)
+    barrier = threading.Barrier(2)
+    statuses = []
+
+    def book(headers):
+        client = app.test_client()
+        barrier.wait()
+        statuses.append(client.post('/simulation/session/start', json={"servant_id": sim_users.servant_id},
+                                    headers=headers).status_code)
+
+    threads = [threading.Thread(target=book, args=(headers,)) for headers in (sim_users.princess, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert sorted(statuses) == [201, 409]
+    with app.app_context():
+        sessions = sim_service.db.session.scalars(sim_service.db.select(sim_service.Session.id).where(
+            sim_service.Session.servant_id == sim_users.servant_id)).all()
+    assert len(sessions) == 1
+
+
+def test_idle_session_reaper(sim_session, monkeypatch):
+    from session_state import SessionStore
+
+    sim_service, app, client = sim_session.service, sim_session.app, sim_session.client
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+    monkeypatch.setattr(sim_service, 'session_store', SessionStore(fakeredis.FakeStrictRedis()))
+    client.post('/simulation/session/end', json={"session_id": session_id}, headers=princess)
+    session_ids = [session_id, client.post('/simulation/session/start', json={"servant_id": sim_session.servant_id},
+                                           headers=princess).get_json()['session_id']]
+
+    socket_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_ids[1]}', headers=servant)
+    socket_client.emit('join_room', {})
+    socket_client.get_received()
+    assert str(session_ids[1]) in sim_service.chat_history._rooms
+    # Stands in for a client on another node, which the reaper cannot disconnect
+    remote_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_ids[1]}', headers=princess)
+
+    # Only the session idle for longer than the timeout is closed
+    assert sim_service.reap_idle_sessions() == 0
+    sim_service.session_activity.touch(session_ids[1], at=time.time() - sim_service.SESSION_IDLE_TIMEOUT - 1)
+    assert sim_service.reap_idle_sessions() == 1
+
+    assert not socket_client.is_connected()
+    assert client.get('/simulation/session/servants-current', headers=servant).status_code == 404
+    with app.app_context():
+        assert sim_service.db.session.get(sim_service.Session, session_ids[1]).end_timestamp is not None
+
+    # Ended sessions, reaped or not, cannot be rejoined or chatted in
+    for ended_id in session_ids:
+        assert not sim_service.socketio.test_client(app, query_string=f'room_id={ended_id}', headers=servant).is_connected()
+    assert remote_client.emit('send_message', {"message": "still there?"}, callback=True) == {"msg": "Session has ended"}
+    # and their histories are gone from this node
+    assert not any(str(ended_id) in sim_service.chat_history._rooms for ended_id in session_ids)
+
+
+def test_chat_resume(sim_session, monkeypatch):
+    from room_events import MemoryRoomStream
+    from flask_jwt_extended import create_access_token
+
+    sim_service, app = sim_session.service, sim_session.app
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+    monkeypatch.setattr(sim_service, 'chat_history', MemoryRoomStream(maxlen=3))
+
+    princess_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=princess)
+    princess_client.emit('join_room', {})
+    princess_client.emit('send_message', {"message": "tea, please"})
+    last_seen = sim_service.chat_history.since(session_id, 0, 10)[0][-1][0]
+    princess_client.emit('send_message', {"message": "and cake"})
+    princess_client.emit('send_message', {"message": "now"})
+
+    # A servant that saw the first message gets the two after it, in order, only for itself
+    servant_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=servant)
+    princess_client.get_received()
+    assert servant_client.emit('resume', {"after": last_seen}, callback=True) == {"replayed": 2, "complete": True}
+    assert [packet['args'] for packet in servant_client.get_received()] == ['Princess: and cake', 'Princess: now']
+    assert princess_client.get_received() == []
+
+    # History is capped, resuming from before the oldest kept message is reported as incomplete
+    assert servant_client.emit('resume', {"after": 0}, callback=True) == {"replayed": 3, "complete": False}
+    for payload in ({"after": "abc"}, {"after": -1}, ["after"], None):
+        for event in ('resume', 'sync'):
+            assert servant_client.emit(event, payload, callback=True) == {"msg": "after must be a sequence number"}
+
+    # A zero-padded room id joins the session's room, one that is not a number is refused
+    padded_client = sim_service.socketio.test_client(app, query_string=f'room_id=0{session_id}', headers=servant)
+    padded_client.emit('join_room', {})
+    princess_client.get_received()
+    princess_client.emit('send_message', {"message": "hello"})
+    assert 'Princess: hello' in [packet['args'] for packet in padded_client.get_received()]
+    for room_id in ('abc', '-1', '99999999999'):
+        assert not sim_service.socketio.test_client(app, query_string=f'room_id={room_id}', headers=servant).is_connected()
+
+    # Characters of other sessions cannot join the room or read its history
+    with app.app_context():
+        outsider = {"Authorization": f'Bearer {create_access_token(identity=random.randint(1, 10 ** 9))}'}
+    sim_session.client.post('/simulation/add_user', json={"is_princess": False}, headers=outsider)
+    sim_session.client.post('/simulation/add_user', json={"is_princess": True}, headers=outsider)
+    assert not sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=outsider).is_connected()
+
+
+def test_request_ids_validated(sim_session):
+    app, client = sim_session.app, sim_session.client
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+    task_id = add_task(app, "Feed the swans")
+
+    # Ids that are not integers are rejected instead of failing in the catalog lookup or the database
+    for bad_id in ([task_id], str(task_id), True, None):
+        response = client.post('/simulation/request/task', json={"task_id": bad_id, "session_id": session_id}, headers=princess)
+        assert response.status_code == 400
+    response = client.post('/simulation/request/task', json={"task_id": task_id, "session_id": [session_id]}, headers=princess)
+    assert response.status_code == 404
+    response = client.post('/simulation/request/tasks', json={"task_ids": task_id, "session_id": session_id}, headers=princess)
+    assert response.status_code == 400
+    response = client.post('/simulation/request/tasks', json={"task_ids": [task_id, [task_id], "x"], "session_id": session_id},
+                           headers=princess)
+    assert response.status_code == 400 and response.get_json()['task_ids'] == [[task_id], "x"]
+
+    request_id = client.post('/simulation/request/task', json={"task_id": task_id, "session_id": session_id},
+                             headers=princess).get_json()['request_id']
+    for request_ids in (request_id, [request_id, "2"], [[request_id]], [True]):
+        response = client.post('/simulation/request/complete/batch', json={"request_ids": request_ids}, headers=servant)
+        assert response.status_code == 400
+    assert client.post('/simulation/request/complete', json={"request_id": [request_id]}, headers=servant).status_code == 404
+    response = client.post('/simulation/request/complete/batch', json={"request_ids": [request_id]}, headers=servant)
+    assert response.get_json()['completed'] == [request_id]
+
+    # Session and servant ids are checked the same way, and a session only ends once
+    assert client.post('/simulation/session/start', json={"servant_id": str(sim_session.servant_id)}, headers=princess).status_code == 404
+    assert client.get('/simulation/session/logs', json={"session_id": str(session_id)}).status_code == 400
+    assert client.post('/simulation/session/end', json={"session_id": str(session_id)}, headers=princess).status_code == 404
+    assert client.post('/simulation/session/end', json={"session_id": session_id}, headers=princess).status_code == 200
+    assert client.post('/simulation/session/end', json={"session_id": session_id}, headers=princess).status_code == 404
+
+
+def test_complete_request(sim_session):
+    sim_service, app, client = sim_session.service, sim_session.app, sim_session.client
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+    request_ids = [client.post('/simulation/request/task', json={"task_id": add_task(app, "Fold the linen"), "session_id": session_id},
+                               headers=princess).get_json()['request_id'] for _ in range(2)]
+
+    # success must be a JSON boolean, the string "false" is not false
+    for success in ("false", 0, None):
+        response = client.post('/simulation/request/complete', json={"request_id": request_ids[0], "success": success}, headers=servant)
+        assert response.status_code == 400
+    assert client.post('/simulation/request/complete/batch', json={"request_ids": request_ids, "success": "false"},
+                       headers=servant).status_code == 400
+
+    # Only the assigned servant completes a request, and only once
+    assert client.post('/simulation/request/complete', json={"request_id": request_ids[0]}, headers=princess).status_code == 404
+    response = client.post('/simulation/request/complete', json={"request_id": request_ids[0], "success": False}, headers=servant)
+    assert response.status_code == 200
+    assert client.post('/simulation/request/complete', json={"request_id": request_ids[0]}, headers=servant).status_code == 409
+    with app.app_context():
+        assert sim_service.db.session.get(sim_service.Request, request_ids[0]).success is False
+
+
+def test_room_stream_complete():
+    from room_events import MemoryRoomStream, RedisRoomStream
+
+    for stream in (MemoryRoomStream(maxlen=2), RedisRoomStream(fakeredis.FakeStrictRedis(), maxlen=2)):
+        assert stream.since(1, 0, 10) == ([], True)
+        # A client that saw events of a room whose history is gone may have missed some
+        assert stream.since(1, 5, 10) == ([], False)
+        for index in range(3):
+            stream.append(1, 'message', {"index": index})
+        assert stream.since(1, 1, 10) == ([(2, 'message', {"index": 1}), (3, 'message', {"index": 2})], True)
+        assert stream.since(1, 3, 10) == ([], True)
+        # A closed room's history is dropped, numbering starts over if it is ever used again
+        stream.drop(1)
+        assert stream.since(1, 0, 10) == ([], True) and stream.append(1, 'message', {}) == 1
+
+
+def test_chat_buffer():
+    from chat_log import ChatBuffer
+
+    batches = []
+    chat = ChatBuffer(batches.append, max_size=3, batch_size=2, put_timeout=0.01,
+                      transient=lambda error: isinstance(error, ConnectionError))
+    assert all(chat.add({"message": index}) for index in range(3))
+    # A full buffer pushes back on the sender instead of growing
+    assert not chat.add({"message": 3})
+    assert chat.flush() == 2 and batches == [[{"message": 0}, {"message": 1}]]
+
+    def failing(rows):
+        raise ConnectionError('database is down')
+    chat.write_rows = failing
+    # However long the database is down, the failed batch is kept
+    for _ in range(50):
+        with pytest.raises(ConnectionError):
+            chat.flush()
+    assert len(chat) == 1
+    # It is written first once the database is back, and close drains the rest
+    chat.write_rows = batches.append
+    assert chat.add({"message": 4})
+    chat.close()
+    assert batches[1:] == [[{"message": 2}], [{"message": 4}]] and len(chat) == 0
+
+    # A row the database rejects is dropped, the rest of its batch and later messages are written
+    def rejecting(rows):
+        if any('\x00' in row["message"] for row in rows):
+            raise ValueError('A string literal cannot contain NUL (0x00) characters.')
+        batches.append(rows)
+    chat = ChatBuffer(rejecting, batch_size=3, put_timeout=0.01)
+    for message in ('tea', 'bad\x00', 'cake'):
+        chat.add({"message": message})
+    with pytest.raises(ValueError):
+        chat.flush()
+    assert chat.flush() == 2 and len(chat) == 0
+    chat.add({"message": "now"})
+    assert chat.flush() == 1
+    assert [row["message"] for batch in batches[3:] for row in batch] == ['tea', 'cake', 'now']
+
+
+def test_chat_transcript_batches(sim_session):
+    sim_service, app = sim_session.service, sim_session.app
+    princess, session_id = sim_session.princess, sim_session.session_id
+
+    socket_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=princess)
+    for message in ('tea, please', 'and cake'):
+        socket_client.emit('send_message', {"message": message})
+    for message in ('bad\x00', {"text": "tea"}, 'x' * (sim_service.CHAT_MESSAGE_MAX_LENGTH + 1)):
+        assert 'msg' in socket_client.emit('send_message', {"message": message}, callback=True)
+    sim_service.chat_buffer.close()
+    with app.app_context():
+        rows = sim_service.db.session.execute(
+            sim_service.db.select(sim_service.ChatMessage.role, sim_service.ChatMessage.message)
+            .where(sim_service.ChatMessage.session_id == session_id).order_by(sim_service.ChatMessage.id)).all()
+    assert [tuple(row) for row in rows] == [('Princess', 'tea, please'), ('Princess', 'and cake')]
+
+
+def test_token_bucket(monkeypatch):
+    from rate_limit import MemoryTokenBucket, RedisTokenBucket, take_all
+
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    for bucket in (MemoryTokenBucket(rate=2, burst=3), RedisTokenBucket(fakeredis.FakeStrictRedis(), 'test', rate=2, burst=3)):
+        assert [bucket.take('sid') for _ in range(3)] == [0, 0, 0]
+        assert bucket.take('sid') == 0.5 and bucket.take('other') == 0
+        now[0] += 0.5
+        assert bucket.take('sid') == 0 and bucket.take('sid') == 0.5
+
+    # Taking from several buckets takes from all of them or, when one is empty, from none
+    shared = fakeredis.FakeStrictRedis()
+    for kind in (lambda rate, burst: MemoryTokenBucket(rate, burst),
+                 lambda rate, burst: RedisTokenBucket(shared, f'test:{burst}', rate, burst)):
+        narrow, wide = kind(rate=1, burst=1), kind(rate=1, burst=2)
+        assert take_all([(narrow, 'sid'), (wide, 'room')]) == [0, 0]
+        assert take_all([(narrow, 'sid'), (wide, 'room')]) == [1, 0]
+        assert wide.take('room') == 0 and wide.take('room') == 1
+
+
+def test_message_rate_limits(sim_session, monkeypatch):
+    from rate_limit import MemoryTokenBucket
+
+    sim_service, app = sim_session.service, sim_session.app
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+    monkeypatch.setattr(sim_service, 'connection_message_limit', MemoryTokenBucket(rate=0.001, burst=2))
+    monkeypatch.setattr(sim_service, 'room_message_limit', MemoryTokenBucket(rate=0.001, burst=3))
+    princess_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=princess)
+    servant_client = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=servant)
+    # The join announcement takes a token like a message, joining again is not announced again
+    princess_client.emit('join_room', {})
+    princess_client.emit('join_room', {})
+    assert [packet['args'] for packet in princess_client.get_received()] == ['Princess has connected.']
+
+    # The princess's second message is over the connection's burst, the servant's second over the room's
+    for sender in (princess_client, princess_client, servant_client, servant_client):
+        sender.emit('send_message', {"message": "tea"})
+    received = princess_client.get_received() + servant_client.get_received()
+    assert [packet['args'] for packet in received if packet['name'] == 'message'] == ['Princess: tea', 'Servant: tea']
+    throttled = [packet['args'][0] for packet in received if packet['name'] == 'throttled']
+    assert [(event['scope'], event['event']) for event in throttled] == [('connection', 'send_message'), ('room', 'send_message')]
+    assert all(event['retry_after'] > 0 for event in throttled)
+
+
+def test_broadcast_batching(sim_session):
+    sim_service, app = sim_session.service, sim_session.app
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+
+    plain = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=princess)
+    batched = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}&batch=1', headers=servant)
+    assert batched.get_received()[0]['args'] == [{"batch": True, "encoding": "json"}]
+    for socket_client in (batched, plain):
+        socket_client.emit('join_room', {})
+    plain.emit('send_message', {"message": "tea, please"})
+    plain.emit('send_message', {"message": "and cake"})
+    sim_service.broadcast_batcher.flush()
+
+    # The plain client gets one event per broadcast, the batching one gets them in order as batches
+    assert [packet['args'] for packet in plain.get_received()] == \
+        ['Princess has connected.', 'Princess: tea, please', 'Princess: and cake']
+    events = [event for packet in batched.get_received() for event in packet['args'][0]['events']]
+    assert [packet['args'][0] for packet in events] == \
+        ['Servant has connected.', 'Princess has connected.', 'Princess: tea, please', 'Princess: and cake']
+    assert all(packet['event'] == 'message' and packet['args'][1] for packet in events)
+
+    # Once the batching client is gone its room's broadcasts are no longer batched
+    batched.disconnect()
+    sim_service.broadcast_batcher.flush()
+    plain.emit('send_message', {"message": "anyone?"})
+    assert sim_service.broadcast_batcher.flush() == 0
+
+
+def test_sub_room_members():
+    from broadcast import MemoryRoomMembers, RedisRoomMembers
+
+    for members in (MemoryRoomMembers(), RedisRoomMembers(fakeredis.FakeStrictRedis())):
+        members.join('1:batch')
+        members.join('1:batch')
+        members.join('2:msgpack')
+        members.leave('1:batch')
+        assert members.active(['1:batch', '1:msgpack', '2:msgpack']) == {'1:batch', '2:msgpack'}
+        members.leave('1:batch')
+        members.leave('2:msgpack')
+        assert members.active(['1:batch', '2:msgpack']) == set()
+
+    # Lookups are cached on each node, a join on another node shows once the cache expires
+    redis_client = fakeredis.FakeStrictRedis()
+    node, other = RedisRoomMembers(redis_client, cache_ttl=60), RedisRoomMembers(redis_client)
+    assert node.active(['3:msgpack']) == set()
+    other.join('3:msgpack')
+    assert node.active(['3:msgpack']) == set()
+    node.cache_ttl = 0
+    assert node.active(['3:msgpack']) == {'3:msgpack'}
+
+    # Counters expire unless a node with members refreshes them, so a dead node's counts go away
+    assert 0 < redis_client.ttl('members:3:msgpack') <= 60
+    redis_client.delete('members:3:msgpack')
+    node.refresh()
+    assert redis_client.get('members:3:msgpack') is None
+    other.refresh()
+    assert redis_client.get('members:3:msgpack') == b'1' and redis_client.ttl('members:3:msgpack') > 0
+
+
+def test_msgpack_encoding(sim_session):
+    import msgpack
+
+    sim_service, app = sim_session.service, sim_session.app
+    princess, servant, session_id = sim_session.princess, sim_session.servant, sim_session.session_id
+
+    # Unknown encodings fall back to JSON
+    fallback = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}&encoding=cbor', headers=princess)
+    assert fallback.get_received()[0]['args'] == [{"batch": False, "encoding": "json"}]
+    fallback.disconnect()
+
+    plain = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}', headers=princess)
+    packed = sim_service.socketio.test_client(app, query_string=f'room_id={session_id}&encoding=msgpack', headers=servant)
+    assert packed.get_received()[0]['args'] == [{"batch": False, "encoding": "msgpack"}]
+    packed.emit('join_room', {})
+    plain.emit('join_room', {})
+    plain.emit('send_message', {"message": "tea, please"})
+
+    # The same broadcasts, as JSON for one client and as binary MessagePack for the other
+    assert [packet['args'] for packet in plain.get_received()] == ['Princess has connected.', 'Princess: tea, please']
+    events = [msgpack.unpackb(packet['args'][0]) for packet in packed.get_received()]
+    assert [(event['event'], event['args'][0]) for event in events] == [
+        ('message', 'Servant has connected.'), ('message', 'Princess has connected.'), ('message', 'Princess: tea, please')]
+    assert packed.emit('resume', {"after": events[1]['args'][1]}, callback=True)['replayed'] == 1
+    assert msgpack.unpackb(packed.get_received()[0]['args'][0])['args'][0] == 'Princess: tea, please'